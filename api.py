@@ -1,11 +1,12 @@
 # Import necessary modules and libraries
-from ml_layer import ML
+from ml_layer import ML, OPTION_STRINGS, PipelineError
 from fastapi import FastAPI
 from pydantic import BaseModel
-import openai
-import redis
+import redis.asyncio as aioredis
 import time
 from fastapi import Request
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+import json
 from datetime import datetime,timedelta
 from sqlalchemy import create_engine,MetaData,Table, Column,DateTime,Integer,Text,select,text,func, inspect
 import sqlalchemy as db
@@ -14,16 +15,79 @@ import time
 from sqlalchemy.ext.asyncio import create_async_engine
 import asyncpg # ocnnects to a prosgres driver like postgres db or postgres bouncer
 import asyncio
+import os
+import random
+from contextlib import asynccontextmanager
+from cache import LLMCache, AppKeyCache, RESULT_CACHE_MAX_SIZE, RESULT_CACHE_REDIS_MAX_SIZE, RESULT_CACHE_TTL
+from llm_clients import ClientRegistry
+from llm_governor import LLMGovernor
+from rate_limit import ZSetRateLimiter, list_rate_limit
+from quota import IssuanceQuota, CHECKED_INSERT_QUERY, QUOTA_LOCK_QUERY, RECENT_ISSUANCE_QUERY
+from worker import enqueue_job, get_job
+from singleflight import SingleFlight, Unshared
+from load import ReplicaLoad
+from tracing import start_trace, span, recent_traces
+from metrics import (DB_POOL_CONNECTIONS, RATE_LIMIT_REJECTIONS, REDIS_POOL_CONNECTIONS, REQUESTS_CANCELLED,
+                     RequestMetricsMiddleware, mark_worker_dead, render)
+from typing import List, Optional
 
 # Initialize FastAPI application
 app = FastAPI()
 
-# Initialize Redis for rate limiting
-r = redis.Redis(host='redis', port=6379, db=0)
+# Max no of redis connections a worker can hold; callers wait up to REDIS_POOL_TIMEOUT seconds for a free one
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.environ.get("REDIS_POOL_TIMEOUT", 5))
+# Max seconds a single redis command (or connecting) can take
+REDIS_SOCKET_TIMEOUT = float(os.environ.get("REDIS_SOCKET_TIMEOUT", 5))
+
+# Initialize Redis (rate limiting, caches, job queue), non blocking and shared by every request of this worker
+redis_pool = aioredis.BlockingConnectionPool(
+    host='redis', port=6379, db=0, decode_responses=True,
+    max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT,
+    socket_timeout=REDIS_SOCKET_TIMEOUT, socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+)
+r = aioredis.Redis(connection_pool=redis_pool)
+zset_limiter = ZSetRateLimiter(r)
+
+# pgbouncer.ini budget shared by every api worker: server connections are capped by
+# min(default_pool_size, max_db_connections) for our single user/database pair
+PGBOUNCER_DEFAULT_POOL_SIZE = int(os.environ.get("PGBOUNCER_DEFAULT_POOL_SIZE", 32))
+PGBOUNCER_MAX_DB_CONNECTIONS = int(os.environ.get("PGBOUNCER_MAX_DB_CONNECTIONS", 97))
+API_REPLICAS = int(os.environ.get("API_REPLICAS", 3))
+UVICORN_WORKERS = int(os.environ.get("UVICORN_WORKERS", 5))
+
+# Database pool of a single worker, by default its share of the pgbouncer budget
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE",
+    max(2, min(PGBOUNCER_DEFAULT_POOL_SIZE,PGBOUNCER_MAX_DB_CONNECTIONS)//(API_REPLICAS*UVICORN_WORKERS))))
+DB_POOL_MIN_SIZE = min(DB_POOL_MAX_SIZE, int(os.environ.get("DB_POOL_MIN_SIZE", 1)))
+DB_ACQUIRE_TIMEOUT = float(os.environ.get("DB_ACQUIRE_TIMEOUT", 5))   # seconds to wait for a free connection
+DB_CONNECT_TIMEOUT = float(os.environ.get("DB_CONNECT_TIMEOUT", 10))  # seconds to open a connection
+DB_COMMAND_TIMEOUT = float(os.environ.get("DB_COMMAND_TIMEOUT", 10))  # seconds a query can take
+DB_CONNECT_ATTEMPTS = int(os.environ.get("DB_CONNECT_ATTEMPTS", 10))
+DB_CONNECT_BACKOFF = 0.5        # first retry delay in seconds, doubled after every failure
+DB_CONNECT_BACKOFF_MAX = 10
+
+RESULT_CACHE_PERSIST = os.environ.get("RESULT_CACHE_PERSIST", "0") == "1"  # also keep whole request results in postgres
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "init.sql")  # applied at startup, see migrate_schema
+SCHEMA_MIGRATION_TIMEOUT = float(os.environ.get("SCHEMA_MIGRATION_TIMEOUT", 10*60))  # seconds, copying old api_keys rows included
+API_KEY_RETENTION = timedelta(days=1)  # expired keys are kept this long, the default retention of api_keys_maintain
+API_KEY_ISSUE_ATTEMPTS = 3      # fresh keys tried when a generated key is already taken
+API_KEY_MAINTENANCE_INTERVAL = float(os.environ.get("API_KEY_MAINTENANCE_INTERVAL", 60*60))  # seconds between partition maintenance runs
+
+db_pool_counters = {"acquired": 0, "acquire_timeouts": 0, "acquire_wait_seconds": 0.0}
 
 # Rate limit config: 100 requests per 60 seconds per IP
 MAX_API_KEYS_LAST_24_HOURS = 10000
 
+# Requests per ip and window allowed to run the ML pipeline; /, /stream, /jobs and /batch share one bucket
+PIPELINE_RATE_LIMIT = 2
+PIPELINE_RATE_WINDOW = 60       # seconds
+PIPELINE_RATE_BUCKET = "pipeline"
+MAX_BATCH_DOCUMENTS = int(os.environ.get("MAX_BATCH_DOCUMENTS", 1000))   # documents accepted by one /batch request
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 8))          # documents of one /batch request processed at once
+
+DISCONNECT_POLL_INTERVAL = float(os.environ.get("DISCONNECT_POLL_INTERVAL", 1))  # seconds between two checks that the client is still there
+
 # Define request schema for main API functionality
 class Item(BaseModel):
     llm_api_key: str       # API key for the language model (e.g., OpenAI)
@@ -31,6 +95,30 @@ class Item(BaseModel):
     option: int            # Option to select processing type or mode
     input_text: str        # Text input to be processed
     no_of_words: int       # Word count limit for processing output
+    tolerance_words: int = 0         # Accept an output this many words off the target
+    tolerance_percent: float = 0.0   # ...or this percentage of the target off, whichever is larger
+    no_cache: bool = False           # Recompute even if an identical request was answered before
+
+# Define request schema for asynchronous jobs
+class JobItem(Item):
+    callback_url: Optional[str] = None   # Optional url the finished job is POSTed to
+
+# Define request schema for one document of a batch
+class Document(BaseModel):
+    id: Optional[str] = None         # Optional caller reference, echoed back with the result
+    option: int
+    input_text: str
+    no_of_words: int
+    tolerance_words: int = 0
+    tolerance_percent: float = 0.0
+    no_cache: bool = False
+
+# Define request schema for batches of documents sharing one set of keys
+class BatchItem(BaseModel):
+    llm_api_key: str
+    app_key: str
+    documents: List[Document]
+    stream: bool = False             # Stream results as NDJSON lines as soon as each document finishes
 
 # Define request schema for API key generation
 class Auth(BaseModel):
@@ -39,10 +127,12 @@ class Auth(BaseModel):
     validity: int          # Requested validity of the API key (in days)
 
 
-async def validate_api_key(name,email,validity):
+def validate_api_key(name,email,validity):
     """
     Validates the API key creation request based on input constraints.
 
+    The issuance quota is checked when the key is stored, see issue_api_key.
+
     Args:
         name (str): Name of the user.
         email (str): Email address of the user.
@@ -59,27 +149,89 @@ async def validate_api_key(name,email,validity):
     
     if(validity>31):
         return "You cannot get an api key with validity for more than 31 days"
+
+    if(validity<1):
+        return "The validity of an api key has to be at least 1 day"
     
-    one_day_time = timedelta(days=1)
-    time_now = datetime.now()
+    return None
 
-    conn  = await create_connection()
-    query = """
-    SELECT COUNT(*) 
-    FROM api_keys
-    WHERE
-     name = $1 AND
-     email = $2 AND
-     time >= $3;
+
+async def load_recent_issuance(name,email,since):
     """
-    count = await conn.fetchval(query,name,email,time_now-one_day_time)
-    await conn.close()
+    Issuance times of a user's keys since the given epoch, used to seed the redis quota counter.
 
-    # print(f"Count for no of current api keys: {count}")
+    Returns:
+        List[float]: Epoch seconds of each key issued since `since`.
+    """
+    async with db_connection() as conn:
+        rows = await conn.fetch(RECENT_ISSUANCE_QUERY,name,email,datetime.fromtimestamp(since))
+    return [row['time'].timestamp() for row in rows]
 
-    if(count==MAX_API_KEYS_LAST_24_HOURS):
-        return "You have exhausted your limit for the creation of the api_keys. Pls try again tomorrow"
-    return None
+
+class DuplicateApiKeyError(Exception):
+    """Raised when a newly generated api key is already stored."""
+
+
+async def claim_api_key(conn,api_key):
+    """
+    Locks api_key for the rest of the transaction and checks that it is not taken yet: the primary key of the
+    partitioned api_keys table includes expires_at, so it does not make api_key unique by itself.
+
+    Raises:
+        DuplicateApiKeyError: If the key is already stored.
+    """
+    await conn.execute("SELECT pg_advisory_xact_lock(hashtext('api_keys'), hashtext($1::text));",api_key)
+    if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM api_keys WHERE api_key = $1);",api_key):
+        raise DuplicateApiKeyError()
+
+
+async def issue_api_key(api_key,name,email,validity):
+    """
+    Stores a new api key if the user has not exhausted the issuance quota of the last 24 hours.
+
+    The quota is reserved atomically in redis before the insert, so concurrent requests cannot both take the last slot.
+    While redis is unavailable the check and the insert run as one postgres statement instead, under a per user
+    advisory lock.
+
+    Returns:
+        bool: True if the key was stored, False if the quota is exhausted.
+
+    Raises:
+        DuplicateApiKeyError: If the key is already stored, a fresh one has to be generated.
+    """
+    time_current = datetime.now()
+    expires_at = time_current + timedelta(days=validity)
+    quota = app.state.issuance_quota
+
+    try:
+        member = await quota.reserve(name,email,time_current.timestamp(),load_recent_issuance)
+    except Exception as e:
+        print(f"Issuance quota redis reservation failed, checking in postgres: {e}")
+        window_start = time_current - timedelta(seconds=quota.window)
+        async with db_connection() as conn:
+            async with conn.transaction():
+                await conn.execute(QUOTA_LOCK_QUERY,name,email)
+                await claim_api_key(conn,api_key)
+                stored = await conn.fetchval(CHECKED_INSERT_QUERY,api_key,name,email,time_current,validity,expires_at,
+                                             window_start,MAX_API_KEYS_LAST_24_HOURS)
+        return stored is not None
+
+    if member is None:
+        return False
+
+    query = """
+      INSERT INTO api_keys (api_key,name,email,time,validity,expires_at) VALUES ($1,$2,$3,$4,$5,$6)
+    """
+    try:
+        async with db_connection() as conn:
+            async with conn.transaction():
+                await claim_api_key(conn,api_key)
+                await conn.execute(query,api_key,name,email,time_current,validity,expires_at)
+    except Exception:
+        await quota.release(name,email,member)
+        raise
+
+    return True
 
 
 def generate_api_key(length_bytes=40):
@@ -87,23 +239,20 @@ def generate_api_key(length_bytes=40):
     random_bytes = secrets.token_urlsafe(length_bytes)
     return random_bytes
 
-def process_endpoint(key: str):
+async def process_endpoint(key: str):
     """
-    Validates and initializes OpenAI client using the given API key.
+    Validates the given API key and returns this worker's pooled OpenAI client for it.
+
+    Clients are reused across requests and share one connection pool, and validation results
+    are cached, see llm_clients.ClientRegistry.
 
     Args:
         key (str): OpenAI API key.
 
     Returns:
-        openai.OpenAI: Initialized client if key is valid, otherwise None.
+        openai.AsyncOpenAI: Client if key is valid, otherwise None.
     """
-    try:
-        client = openai.AsyncOpenAI(api_key=key)
-        client.models.list()
-        return client
-
-    except Exception as e:
-        print(e)
+    return await app.state.llm_clients.validate(key)
 
 
 def validate_input(option:int, input_text:str, no_of_words:int):
@@ -134,43 +283,310 @@ def validate_input(option:int, input_text:str, no_of_words:int):
     return None
 
 
-def rate_limiter(request: Request,WINDOW_SIZE,RATE_LIMIT):
+def word_tolerance(item: Item):
+    """
+    Converts the request's tolerance fields into a number of words.
+
+    Args:
+        item (Item | Document): Request (or batch document) carrying tolerance_words and tolerance_percent.
+
+    Returns:
+        int: Max no of words the output may be off the target by (0 means exact).
+    """
+    from_percent = int(item.no_of_words*item.tolerance_percent/100)
+    return max(0, item.tolerance_words, from_percent)
+
+
+def result_key(input_text,no_of_words,option,tolerance):
+    """
+    Content-addresses a whole request. Expects the whitespace normalized input text.
+
+    Returns:
+        str: sha256 hex digest of everything that determines the processed text.
+    """
+    return LLMCache.make_key({"input_text": input_text, "no_of_words": no_of_words, "option": option, "tolerance": tolerance})
+
+
+async def load_persisted_result(key):
+    """
+    Returns:
+        str | None: The json encoded result stored in postgres within the last RESULT_CACHE_TTL seconds, or None.
+    """
+    query = """
+    SELECT result
+    FROM reduce_results
+    WHERE digest = $1 AND created_at >= $2;
+    """
+    try:
+        async with db_connection() as conn:
+            return await conn.fetchval(query,key,datetime.now()-timedelta(seconds=RESULT_CACHE_TTL))
+    except Exception as e:
+        print(f"Result cache postgres lookup failed: {e}")
+        return None
+
+
+async def persist_result(key,value):
+    query = """
+    INSERT INTO reduce_results (digest,result,created_at) VALUES ($1,$2,$3)
+    ON CONFLICT (digest) DO UPDATE SET result = EXCLUDED.result, created_at = EXCLUDED.created_at;
+    """
+    try:
+        async with db_connection() as conn:
+            await conn.execute(query,key,value,datetime.now())
+    except Exception as e:
+        print(f"Result cache postgres write failed: {e}")
+
+
+async def run_reduce(input_text,no_of_words,option,tolerance,client,no_cache=False):
+    """
+    Runs the ML pipeline, answering identical earlier requests from the result cache
+    (in-process, then redis, then postgres if RESULT_CACHE_PERSIST is set) and
+    identical in-flight requests from the one already running.
+
+    Only results within the tolerance of the target are cached.
+
+    Args:
+        input_text (str): Whitespace normalized input text.
+        no_of_words (int): Target word count.
+        option (int): Processing mode.
+        tolerance (int): Max no of words the output may be off the target by.
+        client (openai.AsyncOpenAI): Client for the caller's LLM key.
+        no_cache (bool): Skip the result cache lookup and the LLM response cache (the fresh result is still cached).
+
+    Returns:
+        Tuple[str, int]: Processed text and its word count.
+    """
+    result_cache = app.state.result_cache
+    key = result_key(input_text,no_of_words,option,tolerance)
+
+    if not no_cache:
+        with span("result_cache") as lookup:
+            cached = await result_cache.get(key)
+            if cached is None and RESULT_CACHE_PERSIST:
+                cached = await load_persisted_result(key)
+                if cached is not None:
+                    await result_cache.set(key,cached)
+            lookup.set(hit=cached is not None)
+        if cached is not None:
+            result = json.loads(cached)
+            return result["processed_text"],result["processed_text_length"]
+
+    async def compute():
+        # a fresh run has to ask the LLM again, replaying cached responses would reproduce the cached result
+        llm_cache = None if no_cache else app.state.llm_cache
+        ml_instance = ML(input_text, no_of_words, OPTION_STRINGS[option],client,cache=llm_cache,
+                         tolerance=tolerance,governor=app.state.llm_governor)
+        with app.state.replica_load.track():
+            processed_text,processed_text_length = await ml_instance.process_text()
+        value = json.dumps({"processed_text": processed_text, "processed_text_length": processed_text_length})
+
+        # interrupted by an error (the caller's key, an open circuit) after getting within the tolerance (otherwise
+        # process_text raises): valid, but duplicates with other keys try for themselves
+        if(ml_instance.error):
+            raise Unshared(value)
+
+        if abs(processed_text_length-no_of_words)<=tolerance:
+            await result_cache.set(key,value)
+            if RESULT_CACHE_PERSIST:
+                await persist_result(key,value)
+        return value
+
+    # identical requests already running on any worker are waited for instead of recomputed
+    with span("pipeline"):
+        result = json.loads(await app.state.single_flight.run(key,compute))
+    return result["processed_text"],result["processed_text_length"]
+
+
+class ClientDisconnected(Exception):
+    """Raised when the work of a request was cancelled because its client went away."""
+
+
+class RequestRejected(Exception):
+
+    def __init__(self, message, outcome):
+        """
+        Raised by admit_pipeline_request, the message is returned to the client as the error.
+
+        Args:
+            message (str): Error message.
+            outcome (str): Trace outcome (rate_limited, auth_failed, llm_key_invalid or invalid_input).
+        """
+        super().__init__(message)
+        self.outcome = outcome
+
+
+async def admit_pipeline_request(item,request: Request):
+    """
+    Checks shared by every endpoint that runs the ML pipeline: the pipeline rate limit (one bucket for all of them),
+    the app key, the LLM key and, for a single document request, its input.
+
+    Args:
+        item (Item | BatchItem): Request body; a batch's documents are validated one by one by the caller.
+        request (Request): FastAPI request object (for rate limiting).
+
+    Returns:
+        openai.AsyncOpenAI: Client for the request's LLM key.
+
+    Raises:
+        RequestRejected: If any check fails.
+    """
+    try:
+        with span("rate_limit"):
+            await rate_limiter(request,RATE_LIMIT=PIPELINE_RATE_LIMIT,WINDOW_SIZE=PIPELINE_RATE_WINDOW,
+                               BUCKET=PIPELINE_RATE_BUCKET)
+    except Exception as e:
+        raise RequestRejected(str(e),"rate_limited")
+
+    with span("auth"):
+        error_message = await authenticate_app_key(item.app_key)
+    if(error_message):
+        raise RequestRejected(error_message,"auth_failed")
+
+    with span("llm_key_validation"):
+        client = await process_endpoint(key=item.llm_api_key)
+    if not (client):
+        raise RequestRejected("endpoint not valid","llm_key_invalid")
+
+    if isinstance(item,Item):
+        validation_msg = validate_input(item.option, item.input_text, item.no_of_words)
+        if validation_msg:
+            raise RequestRejected(validation_msg,"invalid_input")
+
+    return client
+
+
+async def cancel_on_disconnect(request: Request,coro):
+    """
+    Runs coro, cancelling it along with every LLM call it has pending if the client disconnects first.
+    Identical requests waiting on it through the single flight layer take the computation over.
+
+    Args:
+        request (Request): Request the work is done for.
+        coro (Awaitable): The work.
+
+    Returns:
+        The result of coro.
+
+    Raises:
+        ClientDisconnected: If the client went away before the work finished.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done,_ = await asyncio.wait({task},timeout=DISCONNECT_POLL_INTERVAL)
+            if(done):
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                await asyncio.gather(task,return_exceptions=True)
+                REQUESTS_CANCELLED.labels(request.url.path).inc()
+                raise ClientDisconnected()
+    finally:
+        # the handler itself was cancelled
+        task.cancel()
+
+
+async def rate_limiter(request: Request,WINDOW_SIZE,RATE_LIMIT,BACKEND="zset",BUCKET=None):
     """
     Enforces rate limiting using a sliding window algorithm via Redis.
 
     Args:
         request (Request): Incoming HTTP request.
+        WINDOW_SIZE (int): Window size in seconds.
+        RATE_LIMIT (int): Max no of requests per ip in the window.
+        BACKEND (str): "zset" (atomic, one round trip, limited per bucket) or "list" (original implementation).
+        BUCKET (str, optional): Name of the limit, shared by every endpoint using it; the request path if None.
 
-    Returns:
-        dict | None: Error message if limit exceeded, else None.
+    Raises:
+        Exception: If the limit is exceeded.
     """
 
     ip =  request.headers.get('X-Forwarded-For')
-    key = f"{ip}"
-    now = time.time()
-    # print(f"ip : {ip}")
-    # print(f"current time: {now}")
 
-    # Remove timestamps outside the sliding window
-    timestamps = r.lrange(key, 0, -1)
-    valid_timestamps = [float(ts) for ts in timestamps if now - float(ts) <= WINDOW_SIZE]
-    # print(f"Prev timestamps: {valid_timestamps}")
+    if(BACKEND=="list"):
+        allowed = await list_rate_limit(r,f"{ip}",WINDOW_SIZE,RATE_LIMIT)
+    else:
+        allowed = await zset_limiter.allow(f"rate_limit:{BUCKET or request.url.path}:{ip}",WINDOW_SIZE,RATE_LIMIT)
 
-    if len(valid_timestamps) == RATE_LIMIT:
+    if not allowed:
+        RATE_LIMIT_REJECTIONS.labels(request.url.path).inc()
         raise Exception("Too many tries. Please try again later.")
 
-    r.delete(key)
-    for ts in valid_timestamps:
-        r.rpush(key, ts)
+def redis_pool_stats():
+    """
+    Returns:
+        dict: Size and usage of this worker's redis connection pool; saturation is in_use/max_connections.
+    """
+    in_use = len(getattr(redis_pool, "_in_use_connections", ()))
+    idle = len([c for c in getattr(redis_pool, "_available_connections", []) if c is not None])
+    return {
+        "max_connections": redis_pool.max_connections,
+        "in_use": in_use,
+        "idle": idle,
+        "saturation": in_use/redis_pool.max_connections,
+    }
+
+
+async def load_app_key_expiry(app_key):
+    """
+    Looks the app key up in postgres.
+
+    Args:
+        app_key (str): Application key generated through /api_key.
+
+    Returns:
+        float | None: Expiry of the key in epoch seconds (possibly past), or None if it does not exist or its
+        partition has been dropped.
+    """
+    # the expires_at bound lets postgres skip the partitions api_keys_maintain is about to drop, while keys that
+    # expired recently are still found and reported as expired rather than unknown
+    query = """
+    SELECT expires_at
+    FROM api_keys
+    WHERE api_key = $1 AND expires_at > $2;
+    """
+    async with db_connection() as conn:
+        expires_at = await conn.fetchval(query,app_key,datetime.now()-API_KEY_RETENTION)
 
-    r.rpush(key, now)  # Add current timestamp
+    if(expires_at is None):
+        return None
 
-    # timestamps = r.lrange(key, 0, -1)
-    # print(f"Final timestamps: {timestamps}")
+    return expires_at.timestamp()
+
+
+async def authenticate_app_key(app_key):
+    """
+    Checks that the app key exists and has not expired.
+
+    Lookups go through the in-process and redis tiers of the app key cache before reaching postgres.
+
+    Args:
+        app_key (str): Application key generated through /api_key.
+
+    Returns:
+        str or None: Returns an error message string if authentication fails, else None.
+    """
+    expires_at = await app.state.app_key_cache.get_expiry(app_key,load_app_key_expiry)
+
+    if(expires_at is None):
+        return "App key authentication failed. Pls use correct key"
+
+    if(expires_at<time.time()):
+        return "app Api Key has expired"
+
+    return None
+
+
+async def create_pool():
+    """
+    Creates this worker's asyncpg pool to pgbouncer, retrying with jittered exponential backoff.
 
-    r.expire(key, WINDOW_SIZE)  # Auto-expire key after window
+    Returns:
+        asyncpg.Pool: Connection pool sized from the pgbouncer budget (see DB_POOL_MAX_SIZE).
 
-async def create_connection():
+    Raises:
+        Exception: The last connection error once DB_CONNECT_ATTEMPTS attempts have failed.
+    """
 
     user = 'Aditya Goyal'
     password = 'cold feather'
@@ -179,17 +595,135 @@ async def create_connection():
     database = 'short_and_exact'
     POOL_DSN = "postgresql://{0}:{1}@{2}:{3}/{4}".format(user, password, host, port,database)
 
-    while(True):
+    delay = DB_CONNECT_BACKOFF
+    for attempt in range(1,DB_CONNECT_ATTEMPTS+1):
         try:
-            connection_pool = await asyncpg.connect(POOL_DSN)
-            return connection_pool
+            return await asyncpg.create_pool(
+                POOL_DSN,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                timeout=DB_CONNECT_TIMEOUT,
+                command_timeout=DB_COMMAND_TIMEOUT,
+                statement_cache_size=0,  # pgbouncer in transaction mode cannot keep prepared statements
+            )
         except Exception as e:
-            pass
+            if(attempt==DB_CONNECT_ATTEMPTS):
+                raise
+            print(f"Database connection attempt {attempt} failed, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay*random.uniform(0.5,1.5))
+            delay = min(delay*2,DB_CONNECT_BACKOFF_MAX)
+
+
+async def migrate_schema():
+    """
+    Runs init.sql, which is idempotent: creates whatever is missing and upgrades a deployment whose api_keys table
+    predates partitioning (postgres itself only runs init.sql on an empty data directory).
+    """
+    with open(SCHEMA_FILE) as f:
+        schema = f.read()
+    async with db_connection() as conn:
+        # without arguments the whole script is sent as one simple query, so it runs as a single transaction
+        await conn.execute(schema, timeout=SCHEMA_MIGRATION_TIMEOUT)
+
+
+async def maintain_api_keys():
+    """
+    Runs the api_keys partition maintenance (init.sql) every API_KEY_MAINTENANCE_INTERVAL seconds:
+    creates the partitions of the coming days and drops the ones whose keys have all expired.
+    Every worker runs this loop, an advisory lock in postgres lets one of them do the work at a time.
+    Also purges expired persisted results when RESULT_CACHE_PERSIST is set.
+    """
+    while True:
+        try:
+            async with db_connection() as conn:
+                dropped = await conn.fetchval("SELECT api_keys_maintain();")
+                if(RESULT_CACHE_PERSIST):
+                    await conn.execute("DELETE FROM reduce_results WHERE created_at < $1;",
+                                       datetime.now()-timedelta(seconds=RESULT_CACHE_TTL))
+            if(dropped):
+                print(f"Dropped {dropped} expired api_keys partitions")
+        except Exception as e:
+            print(f"api_keys partition maintenance failed: {e}")
+
+        await asyncio.sleep(API_KEY_MAINTENANCE_INTERVAL*random.uniform(0.9,1.1))
+
+
+@asynccontextmanager
+async def db_connection():
+    """
+    Borrows a connection from this worker's pool, waiting at most DB_ACQUIRE_TIMEOUT seconds for one.
+
+    Raises:
+        asyncio.TimeoutError: If no connection frees up in time.
+    """
+    pool = app.state.pool
+    start = time.perf_counter()
+    try:
+        conn = await pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        db_pool_counters["acquire_timeouts"] += 1
+        raise
+
+    db_pool_counters["acquired"] += 1
+    db_pool_counters["acquire_wait_seconds"] += time.perf_counter() - start
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+def db_pool_stats():
+    """
+    Returns:
+        dict: Size, usage and acquire counters of this worker's database pool.
+    """
+    pool = app.state.pool
+    in_use = pool.get_size() - pool.get_idle_size()
+    acquired = db_pool_counters["acquired"]
+    return {
+        "min_size": pool.get_min_size(),
+        "max_size": pool.get_max_size(),
+        "size": pool.get_size(),
+        "idle": pool.get_idle_size(),
+        "in_use": in_use,
+        "saturation": in_use/pool.get_max_size(),
+        "acquired": acquired,
+        "acquire_timeouts": db_pool_counters["acquire_timeouts"],
+        "mean_acquire_wait_ms": 1000*db_pool_counters["acquire_wait_seconds"]/acquired if acquired else 0.0,
+    }
+
+
+def report_pool_usage():
+    """
+    Refreshes this worker's pool gauges; /metrics sums them over every worker.
+    """
+    redis_usage = redis_pool_stats()
+    REDIS_POOL_CONNECTIONS.labels("in_use").set(redis_usage["in_use"])
+    REDIS_POOL_CONNECTIONS.labels("idle").set(redis_usage["idle"])
+    REDIS_POOL_CONNECTIONS.labels("max").set(redis_usage["max_connections"])
+
+    pool = getattr(app.state, "pool", None)
+    if pool is None:
+        return
+    db_usage = db_pool_stats()
+    DB_POOL_CONNECTIONS.labels("in_use").set(db_usage["in_use"])
+    DB_POOL_CONNECTIONS.labels("idle").set(db_usage["idle"])
+    DB_POOL_CONNECTIONS.labels("max").set(db_usage["max_size"])
+
+
+# latency of every request per route, and the pool gauges refreshed after each of them
+app.add_middleware(RequestMetricsMiddleware, on_response=report_pool_usage)
 
 
 @app.on_event("startup")
 async def startup():
 
+    # one asyncpg pool per worker, to pgbouncer
+    app.state.pool = await create_pool()
+
+    # brings the schema (partitioned api_keys, maintenance function, reduce_results) up to date
+    await migrate_schema()
+
     # Getting the api_keys stuff for sqlalchemy queries
     # DEFINE THE DATABASE CREDENTIALS
     user = 'Aditya Goyal'
@@ -212,14 +746,54 @@ async def startup():
     app.state.api_keys = api_keys
     app.state.engine = engine
 
+    # LLM responses are cached in memory per worker and in redis across every replica
+    app.state.llm_cache = LLMCache(redis_client=r)
+
+    # whole request results, keyed on the normalized text, target and option
+    app.state.result_cache = LLMCache(redis_client=r,max_size=RESULT_CACHE_MAX_SIZE,
+                                      redis_max_size=RESULT_CACHE_REDIS_MAX_SIZE,ttl=RESULT_CACHE_TTL,prefix="result_cache")
+
+    # one computation per request digest across every worker, duplicates wait for it
+    app.state.single_flight = SingleFlight(r)
+    await app.state.single_flight.start()
+
+    # app key lookups: in-process, then redis, then postgres
+    app.state.app_key_cache = AppKeyCache(redis_client=r)
+
+    # per (name, email) api key issuance counters, seeded from postgres
+    app.state.issuance_quota = IssuanceQuota(r,MAX_API_KEYS_LAST_24_HOURS)
+
+    # one OpenAI client per LLM key, all sharing a single connection pool
+    app.state.llm_clients = ClientRegistry()
+
+    # every LLM call of this worker: concurrency limits, shared token buckets, retries and circuit breaking
+    app.state.llm_governor = LLMGovernor(redis_client=r)
+
+    # ML runs and pending LLM calls of the whole replica, served to HAProxy's agent check and GET /ready
+    app.state.replica_load = ReplicaLoad(r,lambda: app.state.llm_governor.pending)
+    await app.state.replica_load.start()
+
+    # queue shared with the worker pool (worker.py)
+    app.state.job_redis = r
+
+    # creates upcoming api_keys partitions and drops expired ones
+    app.state.maintenance_task = asyncio.create_task(maintain_api_keys())
+
     # async with engine.begin() as conn: 
     #     output = await conn.execute(text("SELECT name, setting FROM pg_settings WHERE name IN ('max_connections', 'superuser_reserved_connections');"))
     #     print(output.fetchall())
 
 @app.on_event("shutdown")
 async def shutdown():
+    app.state.maintenance_task.cancel()
+    await app.state.replica_load.aclose()
+    await app.state.single_flight.aclose()
     await app.state.engine.dispose()
+    await r.aclose()
+    await redis_pool.disconnect()
+    await app.state.llm_clients.aclose()
     await app.state.pool.close()
+    mark_worker_dead()
 
 
 """
@@ -236,12 +810,73 @@ def health_check(request: Request):
     return {"status": "healthy"}
 
 
+@app.get("/stats")
+def stats(request: Request):
+    """
+    Resource usage of the worker that serves the request (each uvicorn worker has its own pools).
+
+    Returns:
+        dict: Database and redis connection pool usage, cache (LLM, result, app key), issuance quota, single flight, LLM governor and replica load counters.
+    """
+    return {
+        "db_pool": db_pool_stats(),
+        "redis_pool": redis_pool_stats(),
+        "llm_cache": app.state.llm_cache.stats(),
+        "result_cache": app.state.result_cache.stats(),
+        "app_key_cache": app.state.app_key_cache.stats(),
+        "issuance_quota": app.state.issuance_quota.stats(),
+        "single_flight": app.state.single_flight.stats(),
+        "llm_governor": app.state.llm_governor.stats(),
+        "replica_load": app.state.replica_load.stats(),
+    }
+
+
+
+@app.get("/ready")
+async def readiness():
+    """
+    Load of the whole replica (every uvicorn worker), the same figures HAProxy's agent check gets on AGENT_PORT.
+
+    Returns:
+        JSONResponse: Jobs, pending LLM calls, utilization, weight and state; status 503 while the replica drains.
+    """
+    snapshot = await app.state.replica_load.snapshot()
+    return JSONResponse(snapshot, status_code=503 if snapshot["state"]=="drain" else 200)
+
+
+@app.get("/metrics")
+def metrics():
+    """
+    Prometheus metrics of every uvicorn worker of this replica (see metrics.py), unlike /stats which only
+    covers the worker that serves the request.
+
+    Returns:
+        Response: Prometheus text exposition format.
+    """
+    report_pool_usage()
+    body, content_type = render()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/traces")
+def traces(limit: int = 50):
+    """
+    Most recent traces of the worker that serves the request, when TRACE_EXPORTER is memory.
+
+    Returns:
+        dict: Finished traces, newest first, each with its spans (names, durations, attributes).
+    """
+    return {"traces": recent_traces(limit)}
+
 
 @app.get("/")
 async def reduce_content(item: Item,request: Request):
     """
     API endpoint that processes input text based on selected option.
 
+    Sampled requests (TRACE_SAMPLE_RATE, or an `X-Trace: 1` header) are traced, see tracing.py.
+    If the client disconnects before the result is ready, the pipeline and its pending LLM calls are cancelled.
+
     Args:
         item (Item): Input data including API key, text, and config.
         request (Request): FastAPI request object (for rate limiting).
@@ -250,70 +885,207 @@ async def reduce_content(item: Item,request: Request):
         dict: Processed text and word count, or error message.
     """
 
-    RATE_LIMIT = 2
-    WINDOW_SIZE = 60
+    with start_trace("reduce_content",force=request.headers.get("x-trace")=="1",option=item.option,
+                     no_of_words=item.no_of_words,input_chars=len(item.input_text)) as trace:
+        try:
+            client = await admit_pipeline_request(item,request)
+        except RequestRejected as e:
+            trace.set(outcome=e.outcome)
+            return {"error": str(e)}
+
+        option = item.option
+        input_text = item.input_text
+        no_of_words = item.no_of_words
+
+        refined_input_text = " ".join(input_text.split())
+        try:
+            processed_text,processed_text_length = await cancel_on_disconnect(
+                request,run_reduce(refined_input_text,no_of_words,option,word_tolerance(item),client,no_cache=item.no_cache))
+        except ClientDisconnected:
+            trace.set(outcome="cancelled")
+            return {"error": "Client disconnected, processing was cancelled."}
+        except PipelineError as e:
+            trace.set(outcome="failed")
+            return {"error": str(e)}
+        trace.set(outcome="done",processed_text_length=processed_text_length)
+        return {"processed_text": processed_text, "processed_text_length": processed_text_length}
+
+
+@app.get("/stream")
+async def stream_content(item: Item,request: Request):
+    """
+    Streaming variant of the main endpoint, reports progress as server-sent events.
+
+    Emits grammar_fixed, tool_chosen, progress (current word count and text) and retry events while
+    the pipeline runs, then a final done event with the processed text. Closing the connection stops the
+    pipeline, so no further LLM calls are made.
+
+    Args:
+        item (Item): Input data including API key, text, and config.
+        request (Request): FastAPI request object (for rate limiting).
+
+    Returns:
+        StreamingResponse | dict: text/event-stream of progress events, or an error message.
+    """
 
     try:
-        rate_limiter(request,RATE_LIMIT=RATE_LIMIT,WINDOW_SIZE=WINDOW_SIZE)
-    except Exception as e:
+        client = await admit_pipeline_request(item,request)
+    except RequestRejected as e:
         return {"error": str(e)}
 
-    llm_api_key = item.llm_api_key
-    option = item.option
-    input_text = item.input_text
-    no_of_words = item.no_of_words
-    app_key = item.app_key
+    events = asyncio.Queue()
+    refined_input_text = " ".join(item.input_text.split())
+    ml_instance = ML(refined_input_text, item.no_of_words, OPTION_STRINGS[item.option],client,
+                     cache=None if item.no_cache else app.state.llm_cache,tolerance=word_tolerance(item),
+                     governor=app.state.llm_governor,on_event=lambda event,data: events.put_nowait((event,data)))
 
-    # query = select(app.state.api_keys).where(app.state.api_keys.c.api_key == app_key)
+    async def run():
+        try:
+            with app.state.replica_load.track():
+                processed_text,processed_text_length = await ml_instance.process_text()
+        except PipelineError as e:
+            events.put_nowait(("done", {"error": str(e)}))
+            return
+        events.put_nowait(("done", {"processed_text": processed_text, "processed_text_length": processed_text_length}))
+
+    async def event_stream():
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                event,data = await events.get()
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                if(event=="done"):
+                    break
+        finally:
+            # the client went away (or we are done), stop spending LLM calls
+            if not task.done():
+                REQUESTS_CANCELLED.labels(request.url.path).inc()
+            task.cancel()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.post("/jobs")
+async def submit_job(item: JobItem,request: Request):
+    """
+    Queues a text processing job and returns immediately with its id.
 
-    # async with app.state.engine.begin() as conn:
-    #     output_coroutine = await conn.execute(query)
-    
-    # output = output_coroutine.fetchall()
+    The job is picked up by the worker pool (worker.py), poll GET /jobs/{job_id} for the result
+    or pass a callback_url to have it POSTed once finished.
 
-    conn  = await create_connection()
+    Args:
+        item (JobItem): Same fields as the main endpoint, plus an optional callback_url.
+        request (Request): FastAPI request object (for rate limiting).
 
-    query = """
-    SELECT *
-    FROM api_keys
-    WHERE api_key = $1;
+    Returns:
+        dict: The job id, or an error message.
     """
-    output = await conn.fetch(query,app_key)
 
-    # print(f"list of current api keys: {output}")
+    # a bad LLM key is rejected now rather than after the job was queued and run
+    try:
+        await admit_pipeline_request(item,request)
+    except RequestRejected as e:
+        return {"error": str(e)}
 
-    if(len(output)==0):
-        return {"error": "App key authentication failed. Pls use correct key"}
-    
-    api_key_entry = output[0]
-    time_created = api_key_entry['time']
-    validity = api_key_entry['validity']
+    job_id = await enqueue_job(app.state.job_redis, item.llm_api_key, {
+        "option": item.option,
+        "input_text": " ".join(item.input_text.split()),
+        "no_of_words": item.no_of_words,
+        "tolerance": word_tolerance(item),
+        "no_cache": item.no_cache,
+        "callback_url": item.callback_url,
+    })
+    return {"job_id": job_id, "status": "queued"}
 
-    duration1 = timedelta(days=validity)
-    time_expired = time_created + duration1
 
-    if(time_expired<datetime.now()):
-        return {"error": "app Api Key has expired"}
-    
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """
+    Returns the status of a queued job, and its result once it is done.
 
-    client = process_endpoint(key=llm_api_key)
-    if not (client):
-        return {"error": "endpoint not valid"}
+    Args:
+        job_id (str): Id returned by POST /jobs.
 
-    validation_msg = validate_input(option, input_text, no_of_words)
-    if validation_msg:
-        return {"error": validation_msg}
-    
-    if(option==1):
-        option_string = "Concisely present ideas(choose if want to concisely present ideas from a large text within a word count)"
+    Returns:
+        dict: Job status (queued, running, done or failed) with the processed text when done, or an error message.
+    """
+    job = await get_job(app.state.job_redis, job_id)
+    if job is None:
+        return {"error": "Job not found or its result has expired"}
+    return job
 
-    else:
-        option_string = "Shorten text (choose if you want to slightly shorten text to fix it within a word count)"
-    
-    refined_input_text = " ".join(input_text.split())
-    ml_instance = ML(refined_input_text, no_of_words, option_string,client)
-    processed_text,processed_text_length = await ml_instance.process_text()
-    return {"processed_text": processed_text, "processed_text_length": processed_text_length}
+
+@app.post("/batch")
+async def reduce_batch(item: BatchItem,request: Request):
+    """
+    Processes a list of documents, each with its own option and word count, under one app key and LLM key.
+
+    The request is rate limited and authenticated once, then the documents run BATCH_CONCURRENCY at a time.
+    A document that fails validation or processing gets an error entry, the rest of the batch carries on.
+
+    Args:
+        item (BatchItem): Keys, the documents and whether to stream the results.
+        request (Request): FastAPI request object (for rate limiting).
+
+    Returns:
+        dict | StreamingResponse: All results in document order, or with stream=true one NDJSON line per
+        document in completion order. Each result carries the document's index and id.
+    """
+
+    try:
+        client = await admit_pipeline_request(item,request)
+    except RequestRejected as e:
+        return {"error": str(e)}
+
+    if not item.documents:
+        return {"error": "No documents to process."}
+
+    if(len(item.documents)>MAX_BATCH_DOCUMENTS):
+        return {"error": f"A batch cannot have more than {MAX_BATCH_DOCUMENTS} documents."}
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def process_document(index,document):
+        result = {"index": index, "id": document.id}
+
+        validation_msg = validate_input(document.option, document.input_text, document.no_of_words)
+        if validation_msg:
+            return {**result, "error": validation_msg}
+
+        refined_input_text = " ".join(document.input_text.split())
+        try:
+            async with semaphore:
+                processed_text,processed_text_length = await run_reduce(refined_input_text,document.no_of_words,
+                                                                        document.option,word_tolerance(document),
+                                                                        client,no_cache=document.no_cache)
+        except PipelineError as e:
+            return {**result, "error": str(e)}
+        except Exception as e:
+            return {**result, "error": f"Error during processing: {e}"}
+
+        return {**result, "processed_text": processed_text, "processed_text_length": processed_text_length}
+
+    if not item.stream:
+        try:
+            results = await cancel_on_disconnect(request,asyncio.gather(
+                *[process_document(index,document) for index,document in enumerate(item.documents)]))
+        except ClientDisconnected:
+            return {"error": "Client disconnected, processing was cancelled."}
+        return {"results": results}
+
+    async def result_stream():
+        tasks = [asyncio.create_task(process_document(index,document)) for index,document in enumerate(item.documents)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield json.dumps(await finished) + "\n"
+        finally:
+            # the client went away (or we are done), stop spending LLM calls
+            if not all(task.done() for task in tasks):
+                REQUESTS_CANCELLED.labels(request.url.path).inc()
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson")
 
 
 # gets the name, email , and validity 
@@ -334,9 +1106,10 @@ async def generate_key(item: Auth,request: Request):
 
     RATE_LIMIT = 3000
     WINDOW_SIZE = 60
+    RATE_LIMIT_BACKEND = "zset"
 
     try:
-        rate_limiter(request,RATE_LIMIT=RATE_LIMIT,WINDOW_SIZE=WINDOW_SIZE)
+        await rate_limiter(request,RATE_LIMIT=RATE_LIMIT,WINDOW_SIZE=WINDOW_SIZE,BACKEND=RATE_LIMIT_BACKEND)
     except Exception as e:
         return {"error": e.args}
 
@@ -344,24 +1117,21 @@ async def generate_key(item: Auth,request: Request):
     email = item.email.strip()
     validity = item.validity # in days
 
-    error_message = await validate_api_key(name,email,validity)
+    error_message = validate_api_key(name,email,validity)
     if(error_message):
         return {"error": error_message}
-    
-    time_current = datetime.now()
-
-    api_key = generate_api_key()
-
-    conn  = await create_connection()
 
-    query = """
-      INSERT INTO api_keys (api_key,name,email,time,validity) VALUES ($1,$2,$3,$4,$5)
-    """
-    await conn.execute(query,api_key,name,email,time_current,validity)
-    await conn.close()
-    # print(f"output of operation of inserting apikeys into db: {output}")
-
-    return {"api_key": api_key}
+    for attempt in range(API_KEY_ISSUE_ATTEMPTS):
+        api_key = generate_api_key()
+        try:
+            issued = await issue_api_key(api_key,name,email,validity)
+        except DuplicateApiKeyError:
+            continue
+        if not issued:
+            return {"error": "You have exhausted your limit for the creation of the api_keys. Pls try again tomorrow"}
+        return {"api_key": api_key}
+
+    return {"error": "The api key could not be generated, pls try again"}
 
 
 
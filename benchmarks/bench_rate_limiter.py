@@ -0,0 +1,116 @@
+"""
+Compares the original list based rate limiter with the atomic sorted set one against a local redis.
+
+    python benchmarks/bench_rate_limiter.py --host localhost --limit 3000 --calls 3000 --threads 15
+
+Reports per-call latency (mean, p50, p99) as the window fills up, and how many calls each backend lets
+through when --threads clients (own connection each) hammer the same key at once (anything above the limit is a bypass).
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+import redis.asyncio as aioredis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rate_limit import ZSetRateLimiter, list_rate_limit
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered)-1, int(len(ordered)*fraction))]
+
+
+def make_backend(name, redis_client):
+    if name == "list":
+        return lambda key, window, limit: list_rate_limit(redis_client, key, window, limit)
+    return ZSetRateLimiter(redis_client).allow
+
+
+async def latency(name, redis_client, calls, limit, window):
+    """
+    Sequential calls on one key, so the window grows to `calls` entries (capped by `limit`).
+    """
+    allow = make_backend(name, redis_client)
+    key = f"bench:{name}:{uuid.uuid4().hex}"
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        await allow(key, window, limit)
+        samples.append((time.perf_counter() - start)*1000)
+    await redis_client.delete(key)
+
+    return {
+        "calls": calls,
+        "mean_ms": statistics.mean(samples),
+        "p50_ms": percentile(samples, 0.50),
+        "p99_ms": percentile(samples, 0.99),
+    }
+
+
+async def concurrency(name, host, port, threads, calls_per_thread, limit, window):
+    """
+    `threads` clients (like the 15 uvicorn workers) call the same key at once.
+    """
+    key = f"bench:{name}:{uuid.uuid4().hex}"
+
+    async def client():
+        redis_client = aioredis.Redis(host=host, port=port)
+        allow = make_backend(name, redis_client)
+        count = 0
+        for _ in range(calls_per_thread):
+            if await allow(key, window, limit):
+                count += 1
+        await redis_client.aclose()
+        return count
+
+    allowed = await asyncio.gather(*[client() for _ in range(threads)])
+
+    redis_client = aioredis.Redis(host=host, port=port)
+    await redis_client.delete(key)
+    await redis_client.aclose()
+
+    total = sum(allowed)
+    return {"attempts": threads*calls_per_thread, "limit": limit, "allowed": total, "bypassed": max(0, total-limit)}
+
+
+async def run(args):
+    redis_client = aioredis.Redis(host=args.host, port=args.port)
+    results = {}
+    for name in ("list", "zset"):
+        results[name] = {
+            "latency": await latency(name, redis_client, args.calls, args.limit, args.window),
+            "concurrency": await concurrency(name, args.host, args.port, args.threads, args.concurrency_limit,
+                                             args.concurrency_limit, args.window),
+        }
+    await redis_client.aclose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--calls", type=int, default=3000, help="sequential calls for the latency run")
+    parser.add_argument("--limit", type=int, default=3000, help="RATE_LIMIT used by both runs")
+    parser.add_argument("--window", type=int, default=60, help="WINDOW_SIZE in seconds")
+    parser.add_argument("--threads", type=int, default=15, help="concurrent clients for the correctness run")
+    parser.add_argument("--concurrency-limit", type=int, default=100, help="RATE_LIMIT for the correctness run")
+    parser.add_argument("--output", help="also write the results to this json file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
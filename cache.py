@@ -0,0 +1,338 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from metrics import CACHE_LOOKUPS
+
+# Max no of LLM responses kept in memory by each uvicorn worker
+LLM_CACHE_MAX_SIZE = int(os.environ.get("LLM_CACHE_MAX_SIZE", 2048))
+
+# Max no of LLM responses kept in redis (shared by every replica and worker)
+LLM_CACHE_REDIS_MAX_SIZE = int(os.environ.get("LLM_CACHE_REDIS_MAX_SIZE", 100000))
+
+# How long (in seconds) a cached LLM response stays valid
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", 24*60*60))
+
+# Max no of whole request results kept in memory by each uvicorn worker
+RESULT_CACHE_MAX_SIZE = int(os.environ.get("RESULT_CACHE_MAX_SIZE", 512))
+
+# Max no of whole request results kept in redis
+RESULT_CACHE_REDIS_MAX_SIZE = int(os.environ.get("RESULT_CACHE_REDIS_MAX_SIZE", 20000))
+
+# How long (in seconds) a whole request result stays valid
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", 24*60*60))
+
+# Max no of app keys kept in memory by each uvicorn worker
+APP_KEY_CACHE_MAX_SIZE = int(os.environ.get("APP_KEY_CACHE_MAX_SIZE", 10000))
+
+# Max seconds an app key lookup is trusted (never past the key's own expiry)
+APP_KEY_CACHE_TTL = int(os.environ.get("APP_KEY_CACHE_TTL", 5*60))
+
+# Seconds an unknown app key is remembered as unknown
+APP_KEY_NEGATIVE_TTL = int(os.environ.get("APP_KEY_NEGATIVE_TTL", 30))
+
+# cached in place of an expiry for app keys that do not exist
+UNKNOWN_KEY = 0.0
+
+
+# Stores the value, indexes the key by insertion time and evicts the oldest keys once the index goes over the cap.
+# KEYS[1] = cache key, KEYS[2] = index key
+# ARGV[1] = value, ARGV[2] = ttl, ARGV[3] = now, ARGV[4] = max size
+SET_AND_EVICT_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[3]) - tonumber(ARGV[2]))
+
+local overflow = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if overflow <= 0 then
+    return 0
+end
+
+local evicted = redis.call('ZRANGE', KEYS[2], 0, overflow - 1)
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, overflow - 1)
+for _, key in ipairs(evicted) do
+    redis.call('DEL', key)
+end
+return #evicted
+"""
+
+
+class TTLCache:
+
+    def __init__(self, max_size, ttl):
+        """
+        In-process LRU cache whose entries also expire after a fixed time.
+
+        Args:
+            max_size (int): Max no of entries; the least recently used entry is evicted past it.
+            ttl (float): Seconds an entry stays valid after it was set.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns the cached value, or None if the key is missing or expired.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores a value, evicting the least recently used entries if the cache is full.
+
+        Args:
+            key (str): Cache key.
+            value: Value to store.
+            ttl (float, optional): Overrides the default ttl for this entry.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class LLMCache:
+
+    def __init__(self, redis_client=None, max_size=LLM_CACHE_MAX_SIZE, redis_max_size=LLM_CACHE_REDIS_MAX_SIZE,
+                 ttl=LLM_CACHE_TTL, prefix="llm_cache"):
+        """
+        Two tier (in-process LRU, then redis) cache for LLM text responses.
+
+        Args:
+            redis_client (redis.asyncio.Redis, optional): Shared tier. Only the in-process tier is used if None.
+            max_size (int): Max no of entries in the in-process tier.
+            redis_max_size (int): Max no of entries in the redis tier.
+            ttl (int): Seconds an entry stays valid in both tiers.
+            prefix (str): Prefix of every redis key owned by the cache.
+        """
+        self.local = TTLCache(max_size, ttl)
+        self.redis = redis_client
+        self.redis_max_size = redis_max_size
+        self.ttl = ttl
+        self.prefix = prefix
+        self.index_key = f"{prefix}:index"
+
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.redis_evictions = 0
+        self.redis_errors = 0
+
+        self.set_and_evict = redis_client.register_script(SET_AND_EVICT_SCRIPT) if redis_client is not None else None
+
+    @staticmethod
+    def make_key(params):
+        """
+        Content-addresses an LLM call.
+
+        Args:
+            params (dict): Everything that influences the response (model, instructions, input, sampling parameters).
+
+        Returns:
+            str: sha256 hex digest of the canonical json encoding of params.
+        """
+        canonical = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    async def get(self, key):
+        """
+        Looks the key up in memory first and in redis second.
+
+        Returns:
+            str | None: The cached response text, or None on a miss.
+        """
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            CACHE_LOOKUPS.labels(self.prefix, "hit_local").inc()
+            return value
+
+        if self.redis is not None:
+            try:
+                value = await self.redis.get(f"{self.prefix}:{key}")
+            except Exception as e:
+                self.redis_errors += 1
+                print(f"LLM cache redis lookup failed: {e}")
+                value = None
+
+            if value is not None:
+                value = value.decode("utf-8") if isinstance(value, bytes) else value
+                self.local.set(key, value)
+                self.redis_hits += 1
+                CACHE_LOOKUPS.labels(self.prefix, "hit_redis").inc()
+                return value
+
+        self.misses += 1
+        CACHE_LOOKUPS.labels(self.prefix, "miss").inc()
+        return None
+
+    async def set(self, key, value):
+        """
+        Stores the response text in both tiers. Redis failures are logged and otherwise ignored.
+        """
+        self.local.set(key, value)
+
+        if self.redis is None:
+            return
+
+        try:
+            evicted = await self.set_and_evict(
+                keys=[f"{self.prefix}:{key}", self.index_key],
+                args=[value, self.ttl, time.time(), self.redis_max_size],
+            )
+            self.redis_evictions += int(evicted)
+        except Exception as e:
+            self.redis_errors += 1
+            print(f"LLM cache redis write failed: {e}")
+
+    def stats(self):
+        """
+        Returns:
+            dict: Hit/miss/eviction counters of this worker's view of the cache.
+        """
+        lookups = self.local_hits + self.redis_hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": (self.local_hits + self.redis_hits)/lookups if lookups else 0.0,
+            "local_size": len(self.local),
+            "local_evictions": self.local.evictions,
+            "redis_evictions": self.redis_evictions,
+            "redis_errors": self.redis_errors,
+        }
+
+
+class AppKeyCache:
+
+    def __init__(self, redis_client=None, max_size=APP_KEY_CACHE_MAX_SIZE, ttl=APP_KEY_CACHE_TTL,
+                 negative_ttl=APP_KEY_NEGATIVE_TTL, prefix="app_key"):
+        """
+        Three tier (in-process, redis, postgres) lookup of app key expiry times.
+
+        Valid keys are cached for at most `ttl` seconds and never past their own expiry, unknown
+        keys are cached as unknown for `negative_ttl` seconds so repeated bad keys do not reach postgres.
+        Keys are stored hashed.
+
+        Args:
+            redis_client (redis.asyncio.Redis, optional): Shared tier. Only the in-process tier is used if None.
+            max_size (int): Max no of entries in the in-process tier.
+            ttl (int): Max seconds a known key is cached.
+            negative_ttl (int): Seconds an unknown key is cached.
+            prefix (str): Prefix of every redis key owned by the cache.
+        """
+        self.local = TTLCache(max_size, ttl)
+        self.redis = redis_client
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.prefix = prefix
+
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.db_loads = 0
+        self.negative_hits = 0
+        self.redis_errors = 0
+
+    def entry_ttl(self, expires_at):
+        """
+        Returns:
+            float: Seconds an entry may be cached for, given the key's expiry (UNKNOWN_KEY for unknown keys).
+        """
+        if expires_at == UNKNOWN_KEY:
+            return self.negative_ttl
+
+        remaining = expires_at - time.time()
+        if remaining <= 0:
+            # already expired, and it will stay that way
+            return self.ttl
+        return min(self.ttl, remaining)
+
+    async def get_expiry(self, app_key, load):
+        """
+        Returns the expiry of an app key, going to postgres only when neither cache tier knows it.
+
+        Args:
+            app_key (str): App key supplied by the user.
+            load (Callable[[str], Awaitable[float | None]]): Loads the expiry (epoch seconds) from postgres, None if unknown.
+
+        Returns:
+            float | None: Expiry of the key in epoch seconds, or None if the key does not exist.
+        """
+        key = hashlib.sha256(app_key.encode("utf-8")).hexdigest()
+
+        expires_at = self.local.get(key)
+        if expires_at is not None:
+            self.local_hits += 1
+            CACHE_LOOKUPS.labels(self.prefix, "hit_local").inc()
+        elif self.redis is not None:
+            try:
+                cached = await self.redis.get(f"{self.prefix}:{key}")
+            except Exception as e:
+                self.redis_errors += 1
+                print(f"App key cache redis lookup failed: {e}")
+                cached = None
+
+            if cached is not None:
+                expires_at = float(cached)
+                self.local.set(key, expires_at, ttl=self.entry_ttl(expires_at))
+                self.redis_hits += 1
+                CACHE_LOOKUPS.labels(self.prefix, "hit_redis").inc()
+
+        if expires_at is None:
+            self.db_loads += 1
+            CACHE_LOOKUPS.labels(self.prefix, "miss").inc()
+            loaded = await load(app_key)
+            expires_at = UNKNOWN_KEY if loaded is None else loaded
+
+            ttl = self.entry_ttl(expires_at)
+            self.local.set(key, expires_at, ttl=ttl)
+            if self.redis is not None:
+                try:
+                    await self.redis.set(f"{self.prefix}:{key}", expires_at, px=max(1, int(ttl*1000)))
+                except Exception as e:
+                    self.redis_errors += 1
+                    print(f"App key cache redis write failed: {e}")
+
+        if expires_at == UNKNOWN_KEY:
+            self.negative_hits += 1
+            return None
+        return expires_at
+
+    def stats(self):
+        """
+        Returns:
+            dict: Hit counters of this worker's view of the cache; db_loads are the lookups that reached postgres.
+        """
+        lookups = self.local_hits + self.redis_hits + self.db_loads
+        return {
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "db_loads": self.db_loads,
+            "hit_rate": (self.local_hits + self.redis_hits)/lookups if lookups else 0.0,
+            "unknown_key_lookups": self.negative_hits,
+            "local_size": len(self.local),
+            "redis_errors": self.redis_errors,
+        }
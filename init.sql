@@ -1,8 +1,108 @@
+-- Idempotent: run by postgres on an empty database, and by every api worker at startup (api.migrate_schema) so
+-- existing deployments are upgraded in place. The lock serializes the workers (the whole script is one transaction
+-- when run by the api).
+SELECT pg_advisory_xact_lock(hashtext('short_and_exact_schema'));
 
-CREATE TABLE api_keys (
-   api_key TEXT PRIMARY KEY,
+-- Deployments created before api_keys was partitioned have a plain table keyed on api_key alone, without
+-- expires_at: move it aside, it is copied into the partitioned table below and then dropped.
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('api_keys') AND relkind = 'r') THEN
+        ALTER TABLE api_keys RENAME TO api_keys_unpartitioned;
+        ALTER TABLE api_keys_unpartitioned RENAME CONSTRAINT api_keys_pkey TO api_keys_unpartitioned_pkey;
+        DROP INDEX IF EXISTS api_keys_name_email_time_idx;
+        ALTER TABLE api_keys_unpartitioned ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP;
+        UPDATE api_keys_unpartitioned
+        SET expires_at = COALESCE(time, localtimestamp) + COALESCE(validity, 0) * INTERVAL '1 day'
+        WHERE expires_at IS NULL;
+    END IF;
+END;
+$$;
+
+-- partitioned by expiry so expired keys are purged by dropping whole partitions
+-- (the primary key has to include the partition key, so api_key alone is kept unique by api.claim_api_key)
+CREATE TABLE IF NOT EXISTS api_keys (
+   api_key TEXT NOT NULL,
    name TEXT,
    email TEXT,
    time TIMESTAMP,
-   validity INT        
-);
\ No newline at end of file
+   validity INT,
+   expires_at TIMESTAMP NOT NULL,
+   PRIMARY KEY (api_key, expires_at)
+) PARTITION BY RANGE (expires_at);
+
+-- catches keys issued while maintenance has fallen behind, so inserts never fail for lack of a partition
+CREATE TABLE IF NOT EXISTS api_keys_default PARTITION OF api_keys DEFAULT;
+
+-- serves the issuance quota check and the seeding of its redis counters
+CREATE INDEX IF NOT EXISTS api_keys_name_email_time_idx ON api_keys (name, email, time);
+
+-- Creates one partition per day of expiry for the next days_ahead days and drops the partitions whose keys
+-- all expired more than retention ago. Called periodically by every api worker; the advisory lock lets a
+-- single caller do the work at a time (transaction scoped, so it is safe behind pgbouncer in transaction mode).
+-- Returns the no of partitions dropped.
+CREATE OR REPLACE FUNCTION api_keys_maintain(days_ahead INT DEFAULT 35, retention INTERVAL DEFAULT '1 day')
+RETURNS INT AS $$
+DECLARE
+    partition_day DATE;
+    part RECORD;
+    dropped INT := 0;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('api_keys_maintain')) THEN
+        RETURN 0;
+    END IF;
+
+    FOR i IN 0..days_ahead LOOP
+        partition_day := current_date + i;
+        BEGIN
+            EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF api_keys FOR VALUES FROM (%L) TO (%L)',
+                           'api_keys_' || to_char(partition_day, 'YYYYMMDD'), partition_day, partition_day + 1);
+        EXCEPTION WHEN check_violation THEN
+            -- rows for this day already landed in the default partition, they stay there until it is cleaned up
+            RAISE WARNING 'api_keys partition for % not created: %', partition_day, SQLERRM;
+        END;
+    END LOOP;
+
+    FOR part IN
+        SELECT c.relname
+        FROM pg_inherits inh
+        JOIN pg_class c ON c.oid = inh.inhrelid
+        WHERE inh.inhparent = 'api_keys'::regclass AND c.relname ~ '^api_keys_[0-9]{8}$'
+    LOOP
+        IF to_date(right(part.relname, 8), 'YYYYMMDD') + 1 <= localtimestamp - retention THEN
+            EXECUTE format('DROP TABLE %I', part.relname);
+            dropped := dropped + 1;
+        END IF;
+    END LOOP;
+
+    DELETE FROM api_keys_default WHERE expires_at <= localtimestamp - retention;
+
+    RETURN dropped;
+END;
+$$ LANGUAGE plpgsql;
+
+-- partitions first, so the keys copied below land in their day's partition rather than the default one
+SELECT api_keys_maintain();
+
+-- finishes the upgrade of a pre-partitioning deployment: every key keeps working with its original expiry
+DO $$
+BEGIN
+    IF to_regclass('api_keys_unpartitioned') IS NOT NULL THEN
+        INSERT INTO api_keys (api_key, name, email, time, validity, expires_at)
+        SELECT api_key, name, email, time, validity, expires_at
+        FROM api_keys_unpartitioned
+        WHERE expires_at > localtimestamp - INTERVAL '1 day'
+        ON CONFLICT DO NOTHING;
+        DROP TABLE api_keys_unpartitioned;
+    END IF;
+END;
+$$;
+
+-- whole request results, only written when the api runs with RESULT_CACHE_PERSIST=1
+CREATE TABLE IF NOT EXISTS reduce_results (
+   digest TEXT PRIMARY KEY,
+   result TEXT NOT NULL,
+   created_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS reduce_results_created_at_idx ON reduce_results (created_at);
@@ -0,0 +1,103 @@
+import hashlib
+import os
+
+import httpx
+import openai
+
+from cache import TTLCache
+
+# How long (in seconds) a key that passed validation is trusted without asking the provider again
+KEY_VALIDATION_TTL = int(os.environ.get("KEY_VALIDATION_TTL", 10*60))
+
+# How long (in seconds) a key the provider rejected is rejected without asking the provider again
+INVALID_KEY_TTL = int(os.environ.get("INVALID_KEY_TTL", 60))
+
+# Max no of distinct LLM keys (clients and validation results) remembered by a worker
+MAX_CACHED_KEYS = int(os.environ.get("MAX_CACHED_KEYS", 1024))
+
+# Connection pool shared by every client of a worker
+LLM_MAX_CONNECTIONS = int(os.environ.get("LLM_MAX_CONNECTIONS", 100))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("LLM_MAX_KEEPALIVE_CONNECTIONS", 20))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get("LLM_KEEPALIVE_EXPIRY", 60))
+
+# Seconds a single LLM http request may take (connect timeout is kept short)
+LLM_REQUEST_TIMEOUT = float(os.environ.get("LLM_REQUEST_TIMEOUT", 600))
+LLM_CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", 10))
+
+
+def key_id(key):
+    """
+    Returns:
+        str: sha256 hex digest of an LLM key, so the key itself is never used as a dict or cache key.
+    """
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class ClientRegistry:
+
+    def __init__(self):
+        """
+        Per-worker registry of OpenAI clients, keyed by a hash of the LLM key.
+
+        Every client shares one keep-alive, HTTP/2 connection pool to the provider, and key validation
+        results are cached (valid keys for KEY_VALIDATION_TTL, rejected keys for INVALID_KEY_TTL).
+        """
+        self.http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(LLM_REQUEST_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        )
+        self.clients = TTLCache(MAX_CACHED_KEYS, float("inf"))
+        self.valid_keys = TTLCache(MAX_CACHED_KEYS, KEY_VALIDATION_TTL)
+        self.invalid_keys = TTLCache(MAX_CACHED_KEYS, INVALID_KEY_TTL)
+
+    def get_client(self, key):
+        """
+        Returns the client for an LLM key, creating it on first use. Does not validate the key.
+        """
+        client_id = key_id(key)
+        client = self.clients.get(client_id)
+        if client is None:
+            # retries are done by the LLM governor, which also honours the caller's limits between attempts
+            client = openai.AsyncOpenAI(api_key=key, http_client=self.http_client, max_retries=0)
+            self.clients.set(client_id, client)
+        return client
+
+    async def validate(self, key):
+        """
+        Validates an LLM key against the provider, unless a cached answer is available.
+
+        Args:
+            key (str): LLM key supplied by the user.
+
+        Returns:
+            openai.AsyncOpenAI | None: The client if the key is valid, otherwise None.
+        """
+        client_id = key_id(key)
+        if self.invalid_keys.get(client_id):
+            return None
+
+        client = self.get_client(key)
+        if self.valid_keys.get(client_id):
+            return client
+
+        try:
+            await client.models.list()
+        except (openai.AuthenticationError, openai.PermissionDeniedError) as e:
+            print(e)
+            self.invalid_keys.set(client_id, True)
+            return None
+        except Exception as e:
+            # provider unreachable or similar, don't cache either way
+            print(e)
+            return None
+
+        self.valid_keys.set(client_id, True)
+        return client
+
+    async def aclose(self):
+        await self.http_client.aclose()
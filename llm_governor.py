@@ -0,0 +1,316 @@
+import asyncio
+import os
+import random
+import time
+
+import openai
+
+from cache import TTLCache
+from llm_clients import MAX_CACHED_KEYS, key_id
+from metrics import LLM_CALLS_CANCELLED, LLM_CIRCUIT_REJECTIONS, LLM_RETRIES
+
+# Max no of LLM calls all the requests served by one uvicorn worker can have in flight at once
+MAX_CONCURRENT_CALLS_PER_WORKER = int(os.environ.get("MAX_CONCURRENT_CALLS_PER_WORKER", 32))
+
+# Max no of LLM calls one LLM key can have in flight at once, per worker
+MAX_CONCURRENT_CALLS_PER_KEY = int(os.environ.get("MAX_CONCURRENT_CALLS_PER_KEY", 16))
+
+# Token bucket per LLM key, shared by every replica through redis (0 disables it)
+LLM_RATE_PER_KEY = float(os.environ.get("LLM_RATE_PER_KEY", 20))    # calls per second
+LLM_BURST_PER_KEY = int(os.environ.get("LLM_BURST_PER_KEY", 40))
+
+# Seconds a single attempt may take before it is abandoned and retried
+LLM_CALL_TIMEOUT = float(os.environ.get("LLM_CALL_TIMEOUT", 120))
+
+# Retries of a throttled, timed out or failed call, with jittered exponential backoff
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 4))
+LLM_BACKOFF_BASE = 0.5          # seconds, doubled after every attempt
+LLM_BACKOFF_MAX = 30
+
+# Consecutive failures of a key that open its circuit, and seconds before a probe call is let through
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", 8))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", 30))
+
+# Refills the bucket from the redis clock and takes a token, letting the balance go negative so waiting callers
+# are queued in arrival order instead of retrying. Returns how long (in seconds) the caller has to wait for its token.
+# KEYS[1] = bucket hash
+# ARGV[1] = tokens per second, ARGV[2] = burst size
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+local now_s = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or burst)
+local updated = tonumber(redis.call('HGET', KEYS[1], 'updated') or now_s)
+
+tokens = math.min(burst, tokens + (now_s - updated) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now_s)
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+# Errors worth another attempt, everything else (bad request, bad key...) is raised right away
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the provider while a key's circuit is open."""
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        """
+        Opens after `threshold` consecutive failures, then lets a single probe through every `reset_timeout` seconds
+        until one succeeds.
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.probing else "open"
+
+
+def retry_after(error):
+    """
+    Returns:
+        float | None: Seconds the provider asked us to wait (retry-after-ms or retry-after header), if any.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+
+    for header, scale in (("retry-after-ms", 1000), ("retry-after", 1)):
+        value = response.headers.get(header)
+        if value is None:
+            continue
+        try:
+            return float(value)/scale
+        except ValueError:
+            continue
+    return None
+
+
+class LLMGovernor:
+
+    def __init__(self, redis_client=None, max_per_worker=MAX_CONCURRENT_CALLS_PER_WORKER,
+                 max_per_key=MAX_CONCURRENT_CALLS_PER_KEY, rate=LLM_RATE_PER_KEY, burst=LLM_BURST_PER_KEY,
+                 timeout=LLM_CALL_TIMEOUT, max_retries=LLM_MAX_RETRIES, prefix="llm_bucket"):
+        """
+        Single gate for every outbound LLM call of a worker.
+
+        Each attempt waits for a token from the key's bucket, then for a per-worker and a per-key concurrency slot, runs
+        under a timeout and is retried with jittered exponential backoff (at least as long as the provider's
+        Retry-After). A per-key circuit breaker fails calls fast while the provider keeps failing for that key.
+
+        Args:
+            redis_client (redis.asyncio.Redis, optional): Shares the token buckets across replicas; per worker buckets if None.
+            max_per_worker (int): Max no of calls in flight in this worker.
+            max_per_key (int): Max no of calls in flight per LLM key in this worker.
+            rate (float): Tokens per second of each key's bucket, 0 disables the bucket.
+            burst (int): Size of each key's bucket.
+            timeout (float): Seconds a single attempt may take.
+            max_retries (int): Max no of retries of a call.
+            prefix (str): Prefix of every redis key owned by the governor.
+        """
+        self.redis = redis_client
+        self.max_per_worker = max_per_worker
+        self.worker_semaphore = asyncio.Semaphore(max_per_worker)
+        self.max_per_key = max_per_key
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.prefix = prefix
+        self.bucket_script = redis_client.register_script(TOKEN_BUCKET_SCRIPT) if redis_client is not None else None
+
+        self.key_semaphores = TTLCache(MAX_CACHED_KEYS, float("inf"))
+        self.breakers = TTLCache(MAX_CACHED_KEYS, float("inf"))
+        # in-process buckets, used without redis or while it is unavailable: key -> (tokens, updated)
+        self.local_buckets = TTLCache(MAX_CACHED_KEYS, 60*60)
+
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.circuit_rejections = 0
+        self.bucket_wait_seconds = 0.0
+        # calls started and not finished, waiting for a slot, a token or a backoff included
+        self.pending = 0
+
+    def key_state(self, kid):
+        semaphore = self.key_semaphores.get(kid)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_per_key)
+            self.key_semaphores.set(kid, semaphore)
+
+        breaker = self.breakers.get(kid)
+        if breaker is None:
+            breaker = CircuitBreaker()
+            self.breakers.set(kid, breaker)
+
+        return semaphore, breaker
+
+    def local_bucket_wait(self, kid):
+        now = time.monotonic()
+        tokens, updated = self.local_buckets.get(kid) or (self.burst, now)
+        tokens = min(self.burst, tokens + (now - updated)*self.rate) - 1
+        self.local_buckets.set(kid, (tokens, now))
+        return 0.0 if tokens >= 0 else -tokens/self.rate
+
+    async def take_token(self, kid):
+        if self.rate <= 0:
+            return
+
+        wait = None
+        if self.bucket_script is not None:
+            try:
+                wait = float(await self.bucket_script(keys=[f"{self.prefix}:{kid}"], args=[self.rate, self.burst]))
+            except Exception as e:
+                print(f"LLM token bucket redis call failed, using the local bucket: {e}")
+        if wait is None:
+            wait = self.local_bucket_wait(kid)
+
+        if wait > 0:
+            self.bucket_wait_seconds += wait
+            await asyncio.sleep(wait)
+
+    def backoff(self, attempt, error):
+        """
+        Returns:
+            float: Seconds to wait before the next attempt, full jitter but never less than the provider's Retry-After.
+        """
+        delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE*2**attempt))
+        hint = retry_after(error)
+        if hint is not None:
+            delay = max(delay, min(hint, LLM_BACKOFF_MAX))
+        return delay
+
+    async def call(self, client, **params):
+        """
+        Runs client.responses.create(**params) under the governor's limits, retrying transient failures.
+
+        Args:
+            client (openai.AsyncOpenAI): Client of the caller's LLM key (created with max_retries=0).
+            **params: Arguments of responses.create.
+
+        Returns:
+            openai.types.responses.Response: The provider's response.
+
+        Raises:
+            CircuitOpenError: If the key's circuit is open.
+            Exception: The last error once the retries are exhausted, or any non retryable error.
+        """
+        self.pending += 1
+        try:
+            return await self.call_with_retries(client, params)
+        finally:
+            self.pending -= 1
+
+    async def call_with_retries(self, client, params):
+        kid = key_id(client.api_key)
+        key_semaphore, breaker = self.key_state(kid)
+        self.calls += 1
+
+        attempt = 0
+        while True:
+            # allow() lets a single probe through a half open circuit, this attempt is it
+            probe = breaker.state == "open"
+            if not breaker.allow():
+                self.circuit_rejections += 1
+                LLM_CIRCUIT_REJECTIONS.inc()
+                raise CircuitOpenError("LLM provider keeps failing for this key, try again later")
+
+            try:
+                # the token is waited for before taking the slots, a throttled key must not hold them while it sleeps
+                await self.take_token(kid)
+                async with self.worker_semaphore, key_semaphore:
+                    try:
+                        response = await asyncio.wait_for(client.responses.create(**params), timeout=self.timeout)
+                    except RETRYABLE_ERRORS as e:
+                        error = e
+                    except Exception:
+                        # the provider answered, the request itself is at fault
+                        breaker.record_success()
+                        raise
+                    except BaseException:
+                        LLM_CALLS_CANCELLED.inc()
+                        raise
+                    else:
+                        breaker.record_success()
+                        return response
+            except BaseException:
+                # cancelled (waiting for a slot, a token or the provider), says nothing about the provider
+                # but must not leave the probe hanging, or the circuit never closes again
+                if probe:
+                    breaker.probing = False
+                raise
+
+            breaker.record_failure()
+            if isinstance(error, openai.RateLimitError):
+                self.throttled += 1
+            elif isinstance(error, asyncio.TimeoutError):
+                self.timeouts += 1
+
+            if attempt >= self.max_retries:
+                self.failures += 1
+                raise error
+
+            delay = self.backoff(attempt, error)
+            print(f"LLM call failed ({type(error).__name__}), retrying in {delay:.1f}s")
+            attempt += 1
+            self.retries += 1
+            LLM_RETRIES.labels(type(error).__name__).inc()
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        breakers = [self.breakers.get(kid) for kid in list(self.breakers.entries)]
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "circuit_rejections": self.circuit_rejections,
+            "open_circuits": sum(1 for breaker in breakers if breaker is not None and breaker.state != "closed"),
+            "bucket_wait_seconds": self.bucket_wait_seconds,
+            "in_flight": self.max_per_worker - self.worker_semaphore._value,
+            "pending": self.pending,
+        }
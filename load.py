@@ -0,0 +1,198 @@
+import asyncio
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+# ML runs and pending LLM calls one replica (all its uvicorn workers) is sized for; at capacity it asks to be drained
+MAX_JOBS_PER_REPLICA = int(os.environ.get("MAX_JOBS_PER_REPLICA", 40))
+MAX_LLM_CALLS_PER_REPLICA = int(os.environ.get("MAX_LLM_CALLS_PER_REPLICA", 400))
+
+# Fraction of capacity above which the replica reports drain, and the lower fraction it has to fall back under to
+# report ready again (the gap stops it flapping at the threshold)
+DRAIN_AT = float(os.environ.get("DRAIN_AT", 1.0))
+READY_AT = float(os.environ.get("READY_AT", 0.8))
+
+# Seconds between two load reports of a worker; reports older than LOAD_REPORT_STALE intervals are from dead workers
+LOAD_REPORT_INTERVAL = float(os.environ.get("LOAD_REPORT_INTERVAL", 1))
+LOAD_REPORT_STALE = 5
+
+# TCP port HAProxy's agent-check connects to (see haproxy.cfg)
+AGENT_PORT = int(os.environ.get("AGENT_PORT", 7861))
+
+# field of the replica's hash holding its drain state, next to one field per worker
+DRAINING = "draining"
+
+
+class ReplicaLoad:
+
+    def __init__(self, redis_client, pending_llm_calls, replica=None, max_jobs=MAX_JOBS_PER_REPLICA,
+                 max_llm_calls=MAX_LLM_CALLS_PER_REPLICA, drain_at=DRAIN_AT, ready_at=READY_AT,
+                 interval=LOAD_REPORT_INTERVAL, prefix="replica_load"):
+        """
+        Load of this replica, for HAProxy to route new requests to the least loaded one.
+
+        Every worker counts its own ML runs and pending LLM calls and reports them to a redis hash per replica
+        every `interval` seconds, so any worker can answer for the whole replica. The answer is a weight
+        (the share of capacity left) or drain once the replica is at capacity.
+
+        Args:
+            redis_client (redis.asyncio.Redis): Redis client, must decode responses.
+            pending_llm_calls (Callable[[], int]): LLM calls of this worker started and not finished yet.
+            replica (str, optional): Name of the replica; the container hostname if None.
+            max_jobs (int): ML runs the replica is sized for.
+            max_llm_calls (int): Pending LLM calls the replica is sized for.
+            drain_at (float): Fraction of capacity at which the replica reports drain.
+            ready_at (float): Fraction of capacity under which a draining replica reports ready again.
+            interval (float): Seconds between two load reports of a worker.
+            prefix (str): Prefix of every redis key owned by the load reports.
+        """
+        self.redis = redis_client
+        self.pending_llm_calls = pending_llm_calls
+        self.replica = replica or socket.gethostname()
+        self.max_jobs = max_jobs
+        self.max_llm_calls = max_llm_calls
+        self.drain_at = drain_at
+        self.ready_at = ready_at
+        self.interval = interval
+        self.key = f"{prefix}:{self.replica}"
+        self.worker = str(os.getpid())
+
+        self.jobs = 0
+        self.draining = False
+        self.reporter = None
+        self.agent = None
+
+        self.report_errors = 0
+        self.agent_checks = 0
+        self.drains = 0
+
+    @contextmanager
+    def track(self):
+        """
+        Counts the block as one ML run of this worker.
+        """
+        self.jobs += 1
+        try:
+            yield
+        finally:
+            self.jobs -= 1
+
+    async def start(self, port=AGENT_PORT):
+        """
+        Starts reporting this worker's load, and serves the agent check on `port`. Every worker binds the port
+        (SO_REUSEPORT), the kernel hands each check to one of them.
+        """
+        self.reporter = asyncio.create_task(self.report())
+        try:
+            self.agent = await asyncio.start_server(self.handle_agent_check, "0.0.0.0", port, reuse_port=True)
+        except OSError as e:
+            print(f"Agent check server could not start on port {port}: {e}")
+
+    async def aclose(self):
+        if self.reporter is not None:
+            self.reporter.cancel()
+        if self.agent is not None:
+            self.agent.close()
+        try:
+            await self.redis.hdel(self.key, self.worker)
+        except Exception as e:
+            print(f"Load report could not be removed: {e}")
+
+    async def report(self):
+        while True:
+            try:
+                await self.redis.hset(self.key, self.worker, f"{self.jobs} {self.pending_llm_calls()} {time.time()}")
+                await self.redis.expire(self.key, int(self.interval*LOAD_REPORT_STALE) + 1)
+            except Exception as e:
+                self.report_errors += 1
+                print(f"Load report failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def snapshot(self):
+        """
+        Returns:
+            dict: ML runs and pending LLM calls of the whole replica, its utilization (0 to 1+), weight (0 to 100)
+            and state (ready | drain). Only this worker's own load is used if redis is unavailable.
+        """
+        jobs, llm_calls, workers = self.jobs, self.pending_llm_calls(), 1
+        try:
+            reports = await self.redis.hgetall(self.key)
+        except Exception as e:
+            self.report_errors += 1
+            print(f"Load reports could not be read, using this worker's load only: {e}")
+            reports = {}
+
+        # the drain state is shared too, so every worker answers the agent check the same way
+        draining = reports.pop(DRAINING, None) == "1" if reports else self.draining
+
+        oldest = time.time() - self.interval*LOAD_REPORT_STALE
+        for worker, report in reports.items():
+            if worker == self.worker:
+                continue
+            worker_jobs, worker_llm_calls, reported_at = report.split()
+            if float(reported_at) < oldest:
+                continue
+            jobs += int(worker_jobs)
+            llm_calls += int(worker_llm_calls)
+            workers += 1
+
+        utilization = max(jobs/self.max_jobs, llm_calls/self.max_llm_calls)
+        if not draining and utilization >= self.drain_at:
+            draining = True
+            self.drains += 1
+            await self.set_draining(True)
+        elif draining and utilization < self.ready_at:
+            draining = False
+            await self.set_draining(False)
+        self.draining = draining
+
+        return {
+            "replica": self.replica,
+            "workers": workers,
+            "jobs": jobs,
+            "pending_llm_calls": llm_calls,
+            "utilization": utilization,
+            "weight": 0 if self.draining else max(1, round(100*(1 - min(utilization, 1)))),
+            "state": "drain" if self.draining else "ready",
+        }
+
+    async def set_draining(self, draining):
+        try:
+            if draining:
+                await self.redis.hset(self.key, DRAINING, "1")
+            else:
+                await self.redis.hdel(self.key, DRAINING)
+        except Exception as e:
+            self.report_errors += 1
+            print(f"Drain state could not be shared: {e}")
+
+    @staticmethod
+    def agent_reply(snapshot):
+        """
+        Returns:
+            str: HAProxy agent-check reply, "drain" or "ready" with the weight as a percentage of the configured one.
+        """
+        if snapshot["state"] == "drain":
+            return "drain\n"
+        return f"ready up {snapshot['weight']}%\n"
+
+    async def handle_agent_check(self, reader, writer):
+        self.agent_checks += 1
+        try:
+            writer.write(self.agent_reply(await self.snapshot()).encode())
+            await writer.drain()
+        except Exception as e:
+            print(f"Agent check failed: {e}")
+        finally:
+            writer.close()
+
+    def stats(self):
+        return {
+            "jobs": self.jobs,
+            "pending_llm_calls": self.pending_llm_calls(),
+            "draining": self.draining,
+            "drains": self.drains,
+            "agent_checks": self.agent_checks,
+            "report_errors": self.report_errors,
+        }
@@ -1,4 +1,23 @@
-from locust import HttpUser, task,constant
+from locust import HttpUser, task, constant, tag, events
+import os
+import random
+import requests
+
+# Where the offline LLM stub (compose.loadtest.yml) can be reached from the machine running locust
+STUB_URL = os.environ.get("STUB_URL", "http://127.0.0.1:8080")
+
+# Any key works against the stub, use a real one only if you really want to load test OpenAI
+LLM_API_KEY = os.environ.get("LLM_API_KEY", "stub-key")
+
+SAMPLE_TEXT = "Artificial Intelligence (AI) has rapidly evolved from a theoretical concept to a transformative force reshaping industries societies and our everyday lives What was once confined to the realms of science fiction is now an integral part of modern technology — from virtual asistants to autonomous vehicels. But what exactly is AI and why has it garnered such global attention Artificial Intelligence refers to the development of computer systems that can perform tasks typically requiring human intellignce. These tasks include problem solving decision making visual perception speech recognition and natural language processing. AI can be broadly classified into • Narrow AI: Specialized systems designed to perform a single task (e.g., Google Search facial recognition) • General AI: Hypothetical systems with the ability to understand and learn any intellectual task a human can do • Superintelligent AI — a speculative future where machines surpass human intelligence across all feilds. The idea of creating intelligent machines dates back to ancient myths and early mechanical invetions. However, the formal discipline of AI began in the 1950's Alan Turing's seminal paper Computing Machinery and Intelligence proposed the question: Can machines think? Milestones in AI development include • 1956: The Dartmouth Conference considered the birthplace of AI • 1997: IBMs Deep Blue defeated world chess champion Garry Kasparov • 2012–Present Deep learning breakthroughts led to rapid progress in image and speech recognition. AI has permeated nearly every domain of modern life."
+
+# successful reduce requests, to turn the stub's call counter into LLM calls per request
+reduce_requests = 0
+
+
+def random_ip():
+    return f"10.{random.randint(0,255)}.{random.randint(0,255)}.{random.randint(1,254)}"
+
 
 class HelloWorldUser(HttpUser):
 
@@ -12,16 +31,79 @@ class HelloWorldUser(HttpUser):
             "email": "adigoyal0807@gmail.com",
             "validity": 23
         }
-        self.client.get('/api_key', json = params)        
-    # @task
-    # def reduce_content(self):
-    #     params = {
-    #         "llm_api_key": "enter_llm_key",
-
-    #         "app_key": "enter_app_key",
-    #         "option": 1,
-    #         "input_text": "Artificial Intelligence (AI) has rapidly evolved from a theoretical concept to a transformative force reshaping industries societies and our everyday lives What was once confined to the realms of science fiction is now an integral part of modern technology — from virtual asistants to autonomous vehicels. But what exactly is AI and why has it garnered such global attention Artificial Intelligence refers to the development of computer systems that can perform tasks typically requiring human intellignce. These tasks include problem solving decision making visual perception speech recognition and natural language processing. AI can be broadly classified into • Narrow AI: Specialized systems designed to perform a single task (e.g., Google Search facial recognition) • General AI: Hypothetical systems with the ability to understand and learn any intellectual task a human can do • Superintelligent AI — a speculative future where machines surpass human intelligence across all feilds. The idea of creating intelligent machines dates back to ancient myths and early mechanical invetions. However, the formal discipline of AI began in the 1950's Alan Turing's seminal paper Computing Machinery and Intelligence proposed the question: Can machines think? Milestones in AI development include • 1956: The Dartmouth Conference considered the birthplace of AI • 1997: IBMs Deep Blue defeated world chess champion Garry Kasparov • 2012–Present Deep learning breakthroughts led to rapid progress in image and speech recognition. AI has permeated nearly every domain of modern life."
-    #             ,
-    #         "no_of_words": 170
-    #     }
-    #     self.client.get('/', json = params)
\ No newline at end of file
+        self.client.get('/api_key', json = params)
+
+
+class ReduceContentUser(HttpUser):
+    """
+    End-to-end api.reduce_content -> ML.process_text load, meant to run against the LLM stub.
+    Run it alone with `locust -f locustfile.py ReduceContentUser`, and a single option with `--tags concise` or `--tags shorten`.
+    """
+
+    host = "http://127.0.0.1:4000"
+    wait_time = constant(1)
+
+    def on_start(self):
+        # every simulated user gets its own ip (the per-ip rate limit on / is 2 per minute) and app key
+        self.ip = random_ip()
+        params = {
+            "name": f"locust user {self.ip}",
+            "email": "locust@example.com",
+            "validity": 1
+        }
+        output = self.client.get('/api_key', json=params, headers={"X-Forwarded-For": self.ip}).json()
+        self.app_key = output.get("api_key")
+
+    def reduce(self, option, repeat, ratio, name):
+        global reduce_requests
+
+        # a unique opening sentence per request, otherwise every request after the first is answered by the
+        # result cache (or waits on an identical one in flight) instead of running the pipeline
+        input_text = f"Request {random.getrandbits(64):x} follows. " + " ".join([SAMPLE_TEXT]*repeat)
+        params = {
+            "llm_api_key": LLM_API_KEY,
+            "app_key": self.app_key,
+            "option": option,
+            "input_text": input_text,
+            "no_of_words": int(len(input_text.split())*ratio)
+        }
+        # rotate the forwarded ip so the per-ip rate limit does not cap the load
+        headers = {"X-Forwarded-For": random_ip()}
+
+        with self.client.get('/', json=params, headers=headers, name=name, catch_response=True) as response:
+            if "error" in response.json():
+                response.failure(response.json()["error"])
+            else:
+                reduce_requests += 1
+
+    @tag("concise")
+    @task
+    def reduce_content_concise(self):
+        self.reduce(option=1, repeat=4, ratio=0.4, name="/ [option 1, concise]")
+
+    @tag("shorten")
+    @task
+    def reduce_content_shorten(self):
+        self.reduce(option=2, repeat=1, ratio=0.8, name="/ [option 2, shorten]")
+
+
+@events.test_start.add_listener
+def reset_stub_stats(environment, **kwargs):
+    global reduce_requests
+    reduce_requests = 0
+    try:
+        requests.post(f"{STUB_URL}/stats/reset", timeout=5)
+    except Exception as e:
+        print(f"LLM stub not reachable, LLM calls per request will not be reported: {e}")
+
+
+@events.test_stop.add_listener
+def report_llm_calls(environment, **kwargs):
+    try:
+        stats = requests.get(f"{STUB_URL}/stats", timeout=5).json()
+    except Exception:
+        return
+
+    print(f"LLM calls by kind: {stats['by_kind']}")
+    if reduce_requests:
+        print(f"LLM calls per reduce request: {stats['total']/reduce_requests:.1f}")
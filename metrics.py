@@ -0,0 +1,118 @@
+"""
+Prometheus metrics of the api and ML layer.
+
+Every uvicorn worker is its own process, so with PROMETHEUS_MULTIPROC_DIR set (see Dockerfile.api) each worker
+writes its samples to that directory and /metrics aggregates all of them, whichever worker serves the scrape.
+Without it (tests, the job worker) metrics are kept in-process.
+"""
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+
+# LLM calls are attributed to the ML stage (grammar fix, segmentation, or the tool) running when they are made
+llm_stage = contextvars.ContextVar("llm_stage", default="other")
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time to produce a whole response, per endpoint.",
+    ["method", "endpoint", "status"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200),
+)
+RATE_LIMIT_REJECTIONS = Counter("rate_limit_rejections_total", "Requests rejected by the rate limiter.", ["endpoint"])
+REQUESTS_CANCELLED = Counter("requests_cancelled_total", "Requests whose ML work was cancelled because the client left.",
+                             ["endpoint"])
+
+DB_POOL_CONNECTIONS = Gauge("db_pool_connections", "Database pool connections per state.", ["state"],
+                            multiprocess_mode="livesum")
+REDIS_POOL_CONNECTIONS = Gauge("redis_pool_connections", "Redis pool connections per state.", ["state"],
+                               multiprocess_mode="livesum")
+
+LLM_CALLS = Counter("llm_calls_total", "LLM calls per ML stage, cached ones included.", ["stage", "cached"])
+LLM_CALLS_PER_REQUEST = Histogram("llm_calls_per_request", "LLM calls (cache misses) made by one ML run, per stage and in total.",
+                                  ["stage"], buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500))
+LLM_RETRIES = Counter("llm_retries_total", "Retried LLM call attempts per reason.", ["reason"])
+LLM_CIRCUIT_REJECTIONS = Counter("llm_circuit_rejections_total", "LLM calls failed fast by an open circuit.")
+LLM_CALLS_CANCELLED = Counter("llm_calls_cancelled_total", "LLM calls aborted while waiting on the provider.")
+PIPELINE_RETRIES = Counter("pipeline_retries_total", "Orchestrator runs restarted from the best candidate after failing.")
+ORCHESTRATOR_ITERATIONS = Histogram("orchestrator_iterations", "Tool calls made by the orchestrator in one ML run.",
+                                    buckets=(0, 1, 2, 3, 4, 6, 8, 12))
+WORD_COUNT_ERROR = Histogram("word_count_error", "Words between the final text and the target of one ML run.",
+                             buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500))
+
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Cache lookups per cache and outcome (hit_local, hit_redis, miss).",
+                        ["cache", "outcome"])
+
+
+@contextmanager
+def stage(name):
+    """
+    Attributes the LLM calls made inside the block (tasks it spawns included) to the ML stage `name`.
+    """
+    token = llm_stage.set(name)
+    try:
+        yield
+    finally:
+        llm_stage.reset(token)
+
+
+class RequestMetricsMiddleware:
+
+    def __init__(self, app, on_response=None):
+        """
+        Times every http request until its last body chunk is sent (streams included) and counts it per route.
+
+        Args:
+            app (ASGIApp): The wrapped application.
+            on_response (Callable[[], None], optional): Called after every response, e.g. to refresh the pool gauges.
+        """
+        self.app = app
+        self.on_response = on_response
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # the route template, not the raw path, keeps the label set bounded (/jobs/{job_id})
+            route = scope.get("route")
+            endpoint = getattr(route, "path", "unmatched")
+            REQUEST_LATENCY.labels(scope["method"], endpoint, str(status)).observe(time.perf_counter() - start)
+            if self.on_response is not None:
+                try:
+                    self.on_response()
+                except Exception as e:
+                    print(f"Metrics update failed: {e}")
+
+
+def mark_worker_dead():
+    """
+    Drops this worker's live gauges from the aggregate, called when the worker shuts down.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def render():
+    """
+    Returns:
+        Tuple[bytes, str]: Exposition of every metric (all workers when multiprocess) and its content type.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -4,16 +4,149 @@ import nltk
 nltk.download('punkt_tab')
 from nltk.tokenize import sent_tokenize
 from collections import defaultdict
+import asyncio
+import os
+from cache import LLMCache
+from llm_governor import LLMGovernor
+from tracing import span
+from metrics import (LLM_CALLS, LLM_CALLS_PER_REQUEST, ORCHESTRATOR_ITERATIONS, PIPELINE_RETRIES, WORD_COUNT_ERROR,
+                     llm_stage, stage)
 
 #ToDo (ML):
-# store the current least text and least no of words
 # integrate different starting points always
 # fix the multiple .... issue 
 
+# Processing modes selectable through the api's `option` field
+OPTION_STRINGS = {
+    1: "Concisely present ideas(choose if want to concisely present ideas from a large text within a word count)",
+    2: "Shorten text (choose if you want to slightly shorten text to fix it within a word count)",
+}
+
+# Max no of LLM calls a single request (ML instance) can have in flight at once
+MAX_CONCURRENT_CALLS_PER_REQUEST = int(os.environ.get("MAX_CONCURRENT_CALLS_PER_REQUEST", 8))
+
+# used by ML instances that are not handed a governor; per worker limits, retries and circuit breaking without redis
+default_governor = LLMGovernor()
+
+# "serial" rewrites sentences one at a time against a shared budget,
+# "parallel" splits the budget across sentences up front and rewrites them all at once
+SENTENCE_MODE = os.environ.get("SENTENCE_MODE", "serial")
+
+# "local" picks the orchestrator's next tool with deterministic rules, "llm" asks gpt-4.1 to pick it
+ROUTER_POLICY = os.environ.get("ROUTER_POLICY", "local")
+
+# gap (as a fraction of the current word count) above which the local router condenses aggressively
+LARGE_GAP_RATIO = 0.25
+# gap below which the local router only shaves off a few words
+SMALL_GAP_RATIO = 0.05
+
+# max word gap (either way) the local exact-count finisher tries to close without calling the LLM
+FINISHER_MAX_GAP = int(os.environ.get("FINISHER_MAX_GAP", 10))
+
+# (long form, short form) pairs that mean the same thing but differ in count_words
+CONTRACTIONS = [
+    ("do not", "don't"), ("does not", "doesn't"), ("did not", "didn't"),
+    ("is not", "isn't"), ("are not", "aren't"), ("was not", "wasn't"), ("were not", "weren't"),
+    ("have not", "haven't"), ("has not", "hasn't"), ("had not", "hadn't"),
+    ("will not", "won't"), ("would not", "wouldn't"), ("should not", "shouldn't"), ("could not", "couldn't"),
+]
+
+# pronoun + be pairs; only contracted when another word follows and no wh-word precedes ("who you are today",
+# "what it is you do" keep the stressed verb), and "it's" / "there's" are never expanded (also "it has", "there has")
+BE_CONTRACTIONS = [
+    ("it is", "it's"), ("there is", "there's"), ("we are", "we're"), ("they are", "they're"),
+    ("you are", "you're"), ("I am", "I'm"),
+]
+AMBIGUOUS_CONTRACTIONS = ["it's", "there's"]
+WH_WORDS = ["what", "who", "whom", "where", "when", "why", "how", "which", "whatever", "wherever", "however"]
+
+PHRASES = [
+    ("and so on", "etc."), ("in order to", "to"), ("due to the fact that", "because"),
+    ("at this point in time", "now"), ("a number of", "several"), ("prior to", "before"),
+    ("in spite of", "despite"), ("with regard to", "about"), ("in the event that", "if"),
+    ("the majority of", "most"), ("is able to", "can"), ("are able to", "can"),
+]
+
+# (long form, short form) pairs of PHRASES whose short form can be lengthened back in every context
+# ("most" is also "the most", "before" and "etc." end sentences, "because of" / "several of" would not read)
+REVERSIBLE_PHRASES = [("in spite of", "despite")]
+
+# modifiers that can be dropped without changing the meaning of a sentence ("quite a few" is not "a few")
+FILLERS = ["very", "really", "actually", "basically", "truly"]
+
+# adjectives that read naturally with "very" in front of them
+GRADABLE_ADJECTIVES = [
+    "important", "useful", "large", "small", "difficult", "easy", "common", "popular",
+    "significant", "clear", "simple", "different", "similar", "effective", "powerful", "fast",
+]
+
+# words after which a GRADABLE_ADJECTIVES entry is an adjective ("is clear", "a fast car") rather than a verb or
+# adverb ("clear the cache", "people fast"); not / so / too / very are deliberately absent
+ADJECTIVE_CONTEXTS = [
+    "is", "are", "was", "were", "be", "been", "being", "am", "'s", "’s", "'re", "’re",
+    "seems", "seem", "seemed", "becomes", "become", "became", "remains", "remain", "remained",
+    "a", "an", "the", "this", "that", "these", "those", "its", "their", "our", "my", "your", "his", "her",
+]
+
+
+def build_transform(source, target, needs_next_word=False, not_after=()):
+    """
+    Compiles a case-insensitive, whole-word replacement of source by target.
+
+    Args:
+        source (str): Phrase to look for. Apostrophes also match the typographic one (’).
+        target (str): Replacement; its first letter is capitalized when the match was.
+        needs_next_word (bool): Only match when another word follows (e.g. "it is" -> "it's").
+        not_after (Sequence[str]): Words that must not directly precede source.
+
+    Returns:
+        Tuple[regex.Pattern, Callable]: Pattern and replacement function for pattern.sub.
+    """
+    pattern = r"\b" + re.escape(source).replace("'", "['’]")
+    if not_after:
+        pattern = r"(?<!\b(?:" + "|".join(not_after) + r")\s+)" + pattern
+    if source[-1].isalnum():
+        pattern += r"\b"
+    if needs_next_word:
+        pattern += r"(?=\s+\p{L})"
+
+    def replace(match):
+        replacement = target
+        if match.group(0)[0].isupper():
+            replacement = replacement[0].upper() + replacement[1:]
+        # "and so on." -> "etc." rather than "etc.."
+        if replacement.endswith(".") and match.string[match.end():match.end()+1] == ".":
+            replacement = replacement[:-1]
+        return replacement
+
+    return re.compile(pattern, re.IGNORECASE), replace
+
+
+# transforms that lower the word count, tried in order (contractions first, they are the safest)
+SHORTENING_TRANSFORMS = (
+    [build_transform(long, short, needs_next_word=True) for long, short in CONTRACTIONS]
+    + [build_transform(long, short, needs_next_word=True, not_after=WH_WORDS) for long, short in BE_CONTRACTIONS]
+    + [build_transform(long, short) for long, short in PHRASES]
+    # only a filler followed by another word, and not the repeat in "very, very good"
+    + [(re.compile(r"(?<!\b" + filler + r"[,\s]\s*)\b" + filler + r"\s+(?=\p{L})"), "") for filler in FILLERS]
+)
+
+# transforms that raise the word count
+LENGTHENING_TRANSFORMS = (
+    [build_transform(short, long) for long, short in CONTRACTIONS]
+    + [build_transform(short, long) for long, short in BE_CONTRACTIONS if short not in AMBIGUOUS_CONTRACTIONS]
+    + [build_transform(short, long) for long, short in REVERSIBLE_PHRASES]
+    + [(re.compile(r"(?<=(?:\b|\s)(?:" + "|".join(map(re.escape, ADJECTIVE_CONTEXTS)) + r")\s+)\b("
+                   + "|".join(GRADABLE_ADJECTIVES) + r")\b", re.IGNORECASE), r"very \1")]
+)
+
+class PipelineError(Exception):
+    """Raised by process_text when the pipeline failed before producing any text."""
+
 
 class ML: 
 
-    def __init__(self, input_text, number_of_words, option,client):
+    def __init__(self, input_text, number_of_words, option,client,max_concurrency=MAX_CONCURRENT_CALLS_PER_REQUEST,sentence_mode=SENTENCE_MODE,router=ROUTER_POLICY,cache=None,on_event=None,tolerance=0,governor=None):
         """
         Initialize the ML class with input parameters.
 
@@ -22,11 +155,38 @@ class ML:
             number_of_words (int): The target word count for the output.
             option (str): Mode of processing — either concise summarization or slight shortening.
             client (OpenAI client): OpenAI-compatible client to call language model API.
+            max_concurrency (int): Max no of LLM calls this instance can have in flight at once.
+            sentence_mode (str): "serial" or "parallel" sentence rewriting in process_short, increase_words and decrease_words.
+            router (str): "local" or "llm" policy used by the orchestrator to pick the next tool.
+            cache (LLMCache, optional): Cache of LLM responses shared across requests.
+            on_event (Callable[[str, dict], None], optional): Called with progress events as the pipeline runs.
+            tolerance (int): Max no of words the output may be off the target by; 0 means exact.
+            governor (LLMGovernor, optional): Gate every LLM call goes through (concurrency, rate, retries); the worker wide default if None.
         """
         self.input_text = input_text
         self.number_of_words = number_of_words
         self.option = option    
         self.client = client
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.sentence_mode = sentence_mode
+        self.router = router
+        self.cache = cache
+        self.on_event = on_event
+        self.tolerance = tolerance
+        self.governor = governor if governor is not None else default_governor
+
+        # candidate closest to the target seen so far, across every tool call and retry
+        self.best_text = None
+        self.best_gap = None
+        # error that stopped the pipeline early, best_text is then only the best candidate reached before it
+        self.error = None
+
+        # times each prompt was sent by this instance, so retries of a prompt are not answered by its cached reply
+        self.prompts_sent = defaultdict(int)
+
+        # LLM calls that reached the provider per stage, and tools called by the orchestrator, reported to /metrics
+        self.llm_calls = defaultdict(int)
+        self.iterations = 0
 
         self.reg = re.compile(
         r"\b(?:"
@@ -46,6 +206,7 @@ class ML:
 
         The function uses a loop where an LLM selects the most appropriate rewriting tool (e.g., concise rewriting, shortening, word expansion)
         based on the current and target word counts, as well as tool call history. It continues calling tools until the word goal is met.
+        With the "local" router policy the tool is picked by route_locally instead, saving a round trip per iteration.
 
         Args:
             input_text (str): Original text input provided by the user.
@@ -104,7 +265,14 @@ class ML:
         """
 
         dic_history = defaultdict(int)
-        while(curr_count!=word_count_goal):
+        while(abs(curr_count-word_count_goal) > self.tolerance):
+
+            # close small gaps locally before spending another LLM round trip
+            curr_input_text = self.finish_exact(curr_input_text)
+            curr_count = self.count_words(curr_input_text)
+            self.consider(curr_input_text)
+            if(abs(curr_count-word_count_goal) <= self.tolerance):
+                break
 
             message = f"""
                Current word count: {curr_count}
@@ -112,32 +280,87 @@ class ML:
                History of tools called: {dic_history}
             """
 
-            response = await self.client.responses.create(
-                model="gpt-4.1",
-                input = message,
-                top_p=0.3,
-                instructions=system_prompt_segment,
-                tools = tools
-            )
-
-            tool_call = response.output[0]
-            function_str = str(tool_call.name)
-
-            dic_history[function_str] += 1
-
-            print(f"Calling {function_str}")
-
-            curr_input_text = await self.call_function(function_str,curr_input_text)
-            curr_count = self.count_words(curr_input_text)
+            with span("orchestrator_iteration", iteration=sum(dic_history.values())+1, word_count=curr_count,
+                      goal=word_count_goal) as iteration:
+                if self.router == "llm":
+                    self.llm_calls["router"] += 1
+                    LLM_CALLS.labels("router", "false").inc()
+                    with span("llm_call", kind="router", prompt_chars=len(message)):
+                        response = await self.governor.call(
+                            self.client,
+                            model="gpt-4.1",
+                            input = message,
+                            top_p=0.3,
+                            instructions=system_prompt_segment,
+                            tools = tools
+                        )
+
+                    tool_call = response.output[0]
+                    function_str = str(tool_call.name)
+                else:
+                    function_str = self.route_locally(curr_count,word_count_goal,dic_history)
+
+                dic_history[function_str] += 1
+                self.iterations += 1
+
+                print(f"Calling {function_str}")
+                self.emit("tool_chosen", tool=function_str, history=dict(dic_history))
+
+                words_before = curr_count
+                curr_input_text = await self.call_function(function_str,curr_input_text)
+                curr_count = self.count_words(curr_input_text)
+                self.consider(curr_input_text)
+                iteration.set(tool=function_str, word_count_after=curr_count, word_delta=curr_count-words_before)
+            self.emit("progress", word_count=curr_count, best_word_count=self.count_words(self.best_text), text=self.best_text)
 
             liste = [True if dic_history[i]>3 else False for i in dic_history ]
             if True in liste:
                 return "Error: Current iteration failed! Try to increase the no of words you want to reduce to",curr_input_text
 
+        # inside the tolerance already, but the finisher may still get closer for free
+        curr_input_text = self.finish_exact(curr_input_text)
+        self.consider(curr_input_text)
         return "",curr_input_text
         
         
 
+    def route_locally(self,curr_count,word_count_goal,dic_history):
+        """
+        Picks the next rewriting tool with deterministic rules instead of an LLM call.
+
+        The size of the gap between the current and goal word count decides the preferred tools, and
+        tools that have already been called 3 times are skipped (a 4th call fails the orchestrator).
+
+        Args:
+            curr_count (int): Current word count of the text.
+            word_count_goal (int): Goal word count.
+            dic_history (dict): No of times each tool has been called so far.
+
+        Returns:
+            str: Name of the tool to call next.
+        """
+        gap = curr_count - word_count_goal
+
+        if gap < 0:
+            preferences = ["increase_words"]
+        elif gap/curr_count > LARGE_GAP_RATIO:
+            if "Concisely" in self.option:
+                preferences = ["process_concisely","process_short","decrease_words"]
+            else:
+                preferences = ["process_short","process_concisely","decrease_words"]
+        elif gap/curr_count > SMALL_GAP_RATIO:
+            preferences = ["process_short","decrease_words","process_concisely"]
+        else:
+            preferences = ["decrease_words","process_short"]
+
+        for tool in preferences:
+            if dic_history.get(tool,0) < 3:
+                return tool
+
+        return min(preferences, key=lambda tool: dic_history.get(tool,0))
+
+
+
     async def call_function(self,function_name,input_text):
         """
         Dynamically calls the appropriate text rewriting function based on the function name.
@@ -150,17 +373,71 @@ class ML:
         Returns:
             str: The transformed text after applying the specified function.
         """
-        if(function_name=="process_concisely"):
-            return await self.process_concisely(input_text)
+        with stage(function_name):
+            if(function_name=="process_concisely"):
+                return await self.process_concisely(input_text)
 
-        elif(function_name=="process_short"):
-            return await self.process_short(input_text)
+            elif(function_name=="process_short"):
+                return await self.process_short(input_text)
 
-        elif(function_name=="increase_words"):
-            return await self.increase_words(input_text)
+            elif(function_name=="increase_words"):
+                return await self.increase_words(input_text)
 
-        elif(function_name=="decrease_words")  :
-            return await self.decrease_words(input_text)
+            elif(function_name=="decrease_words")  :
+                return await self.decrease_words(input_text)
+
+
+
+    async def complete(self,input_text,instructions,source_text=None):
+        """
+        Runs a single text completion, served from the LLM cache when possible.
+
+        Args:
+            input_text (str): Input passed to the model.
+            instructions (str): System prompt passed to the model.
+            source_text (str, optional): Text being rewritten when input_text wraps it in a prompt (e.g. the current
+                line), the traced word delta is measured against it; input_text if None.
+
+        Returns:
+            str: Stripped text of the model's reply.
+        """
+        params = {
+            "model": "gpt-4.1",
+            "input": input_text,
+            "top_p": 0.3,
+            "instructions": instructions,
+        }
+
+        if source_text is None:
+            source_text = input_text
+
+        with span("llm_call", kind="text", prompt_chars=len(input_text), instructions_chars=len(instructions)) as call:
+            if self.cache is not None:
+                # the nth send of a prompt in a run is cached on its own, retries and no-progress passes
+                # get a fresh reply, while an identical later run replays the same sequence from the cache
+                key = LLMCache.make_key(params)
+                sent = self.prompts_sent[key]
+                self.prompts_sent[key] += 1
+                if sent:
+                    key = LLMCache.make_key({**params, "attempt": sent})
+                text = await self.cache.get(key)
+                if text is not None:
+                    LLM_CALLS.labels(llm_stage.get(), "true").inc()
+                    if call.recording:
+                        call.set(cached=True, response_chars=len(text), word_delta=self.count_words(text)-self.count_words(source_text))
+                    return text
+
+            self.llm_calls[llm_stage.get()] += 1
+            LLM_CALLS.labels(llm_stage.get(), "false").inc()
+            response = await self.governor.call(self.client,**params)
+            text = response.output[0].content[0].text.strip()
+            if call.recording:
+                call.set(cached=False, response_chars=len(text), word_delta=self.count_words(text)-self.count_words(source_text))
+
+            if self.cache is not None:
+                await self.cache.set(key,text)
+
+        return text
 
 
 
@@ -177,6 +454,63 @@ class ML:
         matches = self.reg.findall(text)
         return len(matches)
 
+    def consider(self,text):
+        """
+        Keeps text as the best candidate if it is closer to the target word count than any seen so far.
+        """
+        gap = abs(self.count_words(text) - self.number_of_words)
+        if self.best_gap is None or gap < self.best_gap:
+            self.best_text = text
+            self.best_gap = gap
+
+
+    def emit(self,event,**data):
+        """
+        Reports a progress event (e.g. grammar_fixed, tool_chosen, progress) to the on_event callback, if any.
+        """
+        if self.on_event is not None:
+            self.on_event(event,data)
+
+
+    def finish_exact(self,text):
+        """
+        Closes a small word count gap with local, meaning-preserving transforms instead of LLM calls.
+
+        Each step applies one transform (e.g. "do not" <-> "don't", dropping or adding a filler modifier,
+        "and so on" -> "etc.", "despite" -> "in spite of") to its first occurrence and is kept only if count_words confirms it moved
+        the text closer to the target without overshooting it.
+
+        Args:
+            text (str): Text that is at most FINISHER_MAX_GAP words away from the target.
+
+        Returns:
+            str: The text with the gap closed as far as the transforms allow (unchanged if the gap is too large).
+        """
+        gap = self.count_words(text) - self.number_of_words
+        if gap == 0 or abs(gap) > FINISHER_MAX_GAP:
+            return text
+
+        curr_text = text
+        while gap != 0:
+            transforms = SHORTENING_TRANSFORMS if gap > 0 else LENGTHENING_TRANSFORMS
+
+            for pattern, replacement in transforms:
+                new_text = pattern.sub(replacement, curr_text, count=1)
+                if new_text == curr_text:
+                    continue
+
+                new_gap = self.count_words(new_text) - self.number_of_words
+                if abs(new_gap) < abs(gap):
+                    curr_text, gap = new_text, new_gap
+                    break
+            else:
+                # no transform gets us any closer
+                break
+
+        print(f"Finisher closed the gap to {gap} words")
+        return curr_text
+
+
     async def process_text(self):
         """
         Main entry point for processing the input text to match a target word count while preserving meaning and readability.
@@ -187,21 +521,51 @@ class ML:
 
         Returns:
             Tuple[str, int]: A tuple containing the rewritten text and its final word count.
+
+        Raises:
+            PipelineError: If the pipeline failed (e.g. invalid key, open circuit) before producing any text,
+                or before getting within the tolerance of the target.
         """
 
         try: 
             count = 0
-            input_text = await self.fix_syntax_and_grammar(self.input_text)
+            with span("grammar_fix", word_count=self.count_words(self.input_text)), stage("grammar_fix"):
+                input_text = await self.fix_syntax_and_grammar(self.input_text)
+            self.consider(input_text)
+            self.emit("grammar_fixed", word_count=self.count_words(input_text), text=input_text)
 
             while(True) and count<2:
                 error_msg,processed_text = await self.llm_orchestrator(input_text)
                 if(not error_msg):
                     break
                 count += 1
+                PIPELINE_RETRIES.inc()
+                self.emit("retry", attempt=count, reason=error_msg)
+                # pick up from the closest candidate instead of redoing the work from the start
+                input_text = self.best_text
         except Exception as e:
-            return f"Error during processing: {str(e)}",self.count_words(str(e))
+            self.error = str(e)
+            self.emit("error", error=str(e))
+            if self.best_text is None:
+                raise PipelineError(f"Error during processing: {str(e)}") from e
 
-        return processed_text, self.count_words(processed_text)
+        final_count = self.count_words(self.best_text)
+        # the best candidate may be little more than the grammar fixed input, it is not a result
+        if self.error and abs(final_count - self.number_of_words) > self.tolerance:
+            raise PipelineError(f"Error during processing: {self.error}")
+        self.record_metrics(final_count)
+        return self.best_text, final_count
+
+
+    def record_metrics(self,final_count):
+        """
+        Reports this run's LLM calls per stage, orchestrator iterations and final word count error to /metrics.
+        """
+        for name,calls in self.llm_calls.items():
+            LLM_CALLS_PER_REQUEST.labels(name).observe(calls)
+        LLM_CALLS_PER_REQUEST.labels("total").observe(sum(self.llm_calls.values()))
+        ORCHESTRATOR_ITERATIONS.observe(self.iterations)
+        WORD_COUNT_ERROR.observe(abs(final_count - self.number_of_words))
 
 
     async def fix_syntax_and_grammar(self,input_text):
@@ -223,14 +587,7 @@ class ML:
             "Return ONLY the revised **gramatically corrected paragraph**. Do not explain anything."
         )
 
-        segment_response = await self.client.responses.create(
-            model="gpt-4.1",
-            input=input_text,
-            top_p=0.3,
-            instructions=system_prompt_segment
-        )
-
-        segmented_text = segment_response.output[0].content[0].text.strip()
+        segmented_text = await self.complete(input_text,system_prompt_segment)
 
         return segmented_text 
 
@@ -259,15 +616,10 @@ class ML:
             "Pls dont chnage the word count of the text. Just divide the text into different parts"
         )
 
-        segment_response = await self.client.responses.create(
-            model="gpt-4.1",
-            input=input_text,
-            top_p=0.3,
-            instructions=system_prompt_segment
-        )
-
-        segmented_text = segment_response.output[0].content[0].text.strip()
-        curr_blobs = [b.strip() for b in segmented_text.split("<CHUNK_END>") if b.strip()]
+        with span("segmentation", word_count=self.count_words(input_text)) as segmentation:
+            segmented_text = await self.complete(input_text,system_prompt_segment)
+            curr_blobs = [b.strip() for b in segmented_text.split("<CHUNK_END>") if b.strip()]
+            segmentation.set(chunks=len(curr_blobs))
 
         print(f"Segmented into {len(curr_blobs)} chunks.")
 
@@ -321,15 +673,10 @@ class ML:
                 Return ONLY the revised **shortened paragraph**. Do not explain anything.
             """
 
-            for index in  range(len(curr_blobs)):
-                refine_response = await self.client.responses.create(
-                    model="gpt-4.1",
-                    input=curr_blobs[index],
-                    top_p=0.3,
-                    instructions=system_prompt_concise
-                )
-                refined = refine_response.output[0].content[0].text.strip()
-                curr_blobs[index] = refined
+            # all chunks of a pass are independent, so rewrite them concurrently (gather keeps the order)
+            curr_blobs = list(await asyncio.gather(
+                *[self.rewrite_chunk(blob,system_prompt_concise) for blob in curr_blobs]
+            ))
 
             # Step 3: Combine all refined chunks
             final_output = "\n\n".join(curr_blobs).strip()
@@ -354,6 +701,112 @@ class ML:
 
         final_output = await self.process_short(final_output)
         return final_output
+
+
+    async def rewrite_chunk(self,chunk,instructions):
+        """
+        Rewrites a single idea chunk, bounded by the per-request concurrency limit (and the governor's limits).
+
+        Args:
+            chunk (str): The chunk of text to rewrite.
+            instructions (str): System prompt to rewrite the chunk with.
+
+        Returns:
+            str: The rewritten chunk, or the previous chunk if the LLM call failed.
+        """
+        async with self.semaphore:
+            try:
+                refined = await self.complete(chunk,instructions)
+            except Exception as e:
+                print(f"Chunk rewrite failed, keeping previous text: {e}")
+                return chunk
+
+        return refined if refined else chunk
+
+
+    def allocate_budget(self,lines,total):
+        """
+        Splits a total word delta across sentences, proportionally to their length.
+
+        Uses the largest remainder method so the integer budgets always add up to the total.
+
+        Args:
+            lines (list[str]): Sentences to split the budget across.
+            total (int): Total no of words to add or remove.
+
+        Returns:
+            list[int]: Per-sentence word budget, in the same order as lines.
+        """
+        lengths = [self.count_words(line) for line in lines]
+        total_length = sum(lengths)
+        if total<=0 or total_length==0:
+            return [0]*len(lines)
+
+        shares = [total*length/total_length for length in lengths]
+        budgets = [int(share) for share in shares]
+
+        remaining = total - sum(budgets)
+        by_remainder = sorted(range(len(lines)), key=lambda i: shares[i]-budgets[i], reverse=True)
+        for i in by_remainder[:remaining]:
+            budgets[i] += 1
+
+        return budgets
+
+
+    async def rewrite_lines_parallel(self,lines,to_change,system_prompt,direction):
+        """
+        Rewrites every sentence concurrently, each against its own precomputed word budget.
+
+        Once all replies are in, a single reconciliation step accepts the rewrites with the largest
+        progress first and skips any rewrite that would overshoot the total budget.
+
+        Args:
+            lines (list[str]): Sentences to rewrite.
+            to_change (int): Total no of words to add or remove.
+            system_prompt (str): System prompt of the calling tool.
+            direction (str): "reduce" or "increase".
+
+        Returns:
+            Tuple[list[str], int]: The reconciled sentences and the no of words actually changed.
+        """
+        budgets = self.allocate_budget(lines,to_change)
+
+        async def rewrite(line,budget):
+            if budget<=0:
+                return line
+
+            user_input = (
+                f"Current line:\n{line}\n\n"
+                f"Max no words you can {direction}: {budget}"
+            )
+
+            async with self.semaphore:
+                try:
+                    return await self.complete(user_input,system_prompt,source_text=line)
+                except Exception as e:
+                    print(f"Sentence rewrite failed, keeping previous text: {e}")
+                    return line
+
+        candidates = await asyncio.gather(*[rewrite(line,budget) for line,budget in zip(lines,budgets)])
+
+        # progress made by each rewrite in the wanted direction
+        deltas = []
+        for line,candidate in zip(lines,candidates):
+            delta = self.count_words(line) - self.count_words(candidate)
+            deltas.append(delta if direction=="reduce" else -delta)
+
+        # reconciliation: take the biggest wins first, never overshoot the total budget
+        new_lines = list(lines)
+        changed = 0
+        for i in sorted(range(len(lines)), key=lambda i: deltas[i], reverse=True):
+            if deltas[i] <= 0:
+                break
+            if changed + deltas[i] > to_change:
+                continue
+            new_lines[i] = candidates[i]
+            changed += deltas[i]
+
+        return new_lines, changed
     
 
 
@@ -409,33 +862,30 @@ class ML:
         count = 0
         while(to_reduce > 0) and count<3:
 
-            for i, line in enumerate(optimized_lines):
-                if to_reduce <= 0:
-                    print("breaking before")
-                    break  # Stop if target met
-
-                user_input = (
-                    f"Current line:\n{line}\n\n"
-                    f"Max no words you can reduce: {to_reduce}"
-                )
+            if self.sentence_mode == "parallel":
+                optimized_lines, delta = await self.rewrite_lines_parallel(optimized_lines,to_reduce,system_prompt,"reduce")
+                to_reduce -= delta
+            else:
+                for i, line in enumerate(optimized_lines):
+                    if to_reduce <= 0:
+                        print("breaking before")
+                        break  # Stop if target met
 
-                response = await self.client.responses.create(
-                    model="gpt-4.1",
-                    input = f"{user_input}",
-                    top_p = 0.3,
-                    instructions = system_prompt
-                )
+                    user_input = (
+                        f"Current line:\n{line}\n\n"
+                        f"Max no words you can reduce: {to_reduce}"
+                    )
 
-                shortened = response.output[0].content[0].text.strip()
+                    shortened = await self.complete(user_input,system_prompt,source_text=line)
 
-                # Update word budget
-                old_len = self.count_words(line)
-                new_len = self.count_words(shortened)
-                delta = old_len - new_len
+                    # Update word budget
+                    old_len = self.count_words(line)
+                    new_len = self.count_words(shortened)
+                    delta = old_len - new_len
 
-                if delta > 0:
-                    optimized_lines[i] = shortened
-                    to_reduce -= delta
+                    if delta > 0:
+                        optimized_lines[i] = shortened
+                        to_reduce -= delta
 
 
             curr_text = ". ".join(optimized_lines).strip()
@@ -449,7 +899,7 @@ class ML:
             print(f"Current word count: {curr_no_of_words}, Words to reduce: {to_reduce}")
 
 
-        final_text = ". ".join(optimized_lines).strip()
+        final_text = self.finish_exact(". ".join(optimized_lines).strip())
         final_no_of_words = self.count_words(final_text)
 
         print("Final no of words: " + str(final_no_of_words))
@@ -525,32 +975,29 @@ class ML:
         count = 0
         while(to_increase > 0) and count<3:
 
-            for i, line in enumerate(optimized_lines):
-                if to_increase <= 0:
-                    break  
-
-                user_input = (
-                    f"Current line:\n{line}\n\n"
-                    f"Max no words you can increase: {to_increase}"
-                )
+            if self.sentence_mode == "parallel":
+                optimized_lines, delta = await self.rewrite_lines_parallel(optimized_lines,to_increase,system_prompt,"increase")
+                to_increase -= delta
+            else:
+                for i, line in enumerate(optimized_lines):
+                    if to_increase <= 0:
+                        break  
 
-                response = await self.client.responses.create(
-                    model="gpt-4.1",
-                    input = f"{user_input}",
-                    top_p = 0.3,
-                    instructions = system_prompt
-                )
+                    user_input = (
+                        f"Current line:\n{line}\n\n"
+                        f"Max no words you can increase: {to_increase}"
+                    )
 
-                increased = response.output[0].content[0].text.strip()
+                    increased = await self.complete(user_input,system_prompt,source_text=line)
 
-                # Update word budget
-                old_len = self.count_words(line)
-                new_len = self.count_words(increased)
-                delta = new_len - old_len
+                    # Update word budget
+                    old_len = self.count_words(line)
+                    new_len = self.count_words(increased)
+                    delta = new_len - old_len
 
-                if delta > 0:
-                    optimized_lines[i] = increased
-                    to_increase -= delta
+                    if delta > 0:
+                        optimized_lines[i] = increased
+                        to_increase -= delta
 
 
             curr_text = ". ".join(optimized_lines).strip()
@@ -635,32 +1082,29 @@ class ML:
         count = 0
         while(to_reduce > 0) and count<3:
 
-            for i, line in enumerate(optimized_lines):
-                if to_reduce <= 0:
-                    break  
-
-                user_input = (
-                    f"Current line:\n{line}\n\n"
-                    f"Max no words you can reduce: {to_reduce}"
-                )
+            if self.sentence_mode == "parallel":
+                optimized_lines, delta = await self.rewrite_lines_parallel(optimized_lines,to_reduce,system_prompt,"reduce")
+                to_reduce -= delta
+            else:
+                for i, line in enumerate(optimized_lines):
+                    if to_reduce <= 0:
+                        break  
 
-                response = await self.client.responses.create(
-                    model="gpt-4.1",
-                    input = f"{user_input}",
-                    top_p = 0.3,
-                    instructions = system_prompt
-                )
+                    user_input = (
+                        f"Current line:\n{line}\n\n"
+                        f"Max no words you can reduce: {to_reduce}"
+                    )
 
-                shortened = response.output[0].content[0].text.strip()
+                    shortened = await self.complete(user_input,system_prompt,source_text=line)
 
-                # Update word budget
-                old_len = self.count_words(line)
-                new_len = self.count_words(shortened)
-                delta = old_len - new_len
+                    # Update word budget
+                    old_len = self.count_words(line)
+                    new_len = self.count_words(shortened)
+                    delta = old_len - new_len
 
-                if delta > 0:
-                    optimized_lines[i] = shortened
-                    to_reduce -= delta
+                    if delta > 0:
+                        optimized_lines[i] = shortened
+                        to_reduce -= delta
 
 
             curr_text = ". ".join(optimized_lines).strip()
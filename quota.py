@@ -0,0 +1,135 @@
+import time
+
+# Rolling window of the api key issuance quota, in seconds
+QUOTA_WINDOW = 24*60*60
+
+# Trims the window, checks the quota and records the issuance in a single atomic round trip.
+# A missing counter is reported as cold (-1) until it is seeded with the issuance times found in postgres.
+# Seeded counters hold a '_seeded' marker scored +inf, so they exist (and never count it) even with no issuance.
+# KEYS[1] = sorted set of issuance timestamps (s)
+# ARGV[1] = now, ARGV[2] = window size (s), ARGV[3] = max issuances in the window, ARGV[4] = unique member for this issuance
+# ARGV[5] = "seed" to create a missing counter, ARGV[6..] = issuance timestamps to seed it with
+RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if ARGV[5] ~= 'seed' then
+        return -1
+    end
+    redis.call('ZADD', KEYS[1], 'inf', '_seeded')
+    for i = 6, #ARGV do
+        redis.call('ZADD', KEYS[1], ARGV[i], 'seed:' .. i)
+    end
+end
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. (now - window))
+redis.call('EXPIRE', KEYS[1], window)
+if redis.call('ZCARD', KEYS[1]) - 1 >= tonumber(ARGV[3]) then
+    return 0
+end
+
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+return 1
+"""
+
+# Postgres only fallback, used while redis is unavailable: taken in the same transaction before
+# CHECKED_INSERT_QUERY, it serializes the concurrent issuances of a user so they cannot both pass the check.
+# Transaction scoped, so it is safe behind pgbouncer in transaction mode.
+# $1 = name, $2 = email
+QUOTA_LOCK_QUERY = """
+SELECT pg_advisory_xact_lock(hashtext(length($1::text) || ':' || $1::text || $2::text));
+"""
+
+# Checks the quota on the (name, email, time) index and inserts the key in one statement, under QUOTA_LOCK_QUERY.
+# A key never expires before it is issued, so the expires_at bound only prunes partitions of long expired keys.
+# $1 = api key, $2 = name, $3 = email, $4 = time, $5 = validity, $6 = expires at, $7 = window start, $8 = max issuances
+CHECKED_INSERT_QUERY = """
+INSERT INTO api_keys (api_key,name,email,time,validity,expires_at)
+SELECT $1::text, $2::text, $3::text, $4::timestamp, $5::int, $6::timestamp
+WHERE (
+    SELECT COUNT(*)
+    FROM api_keys
+    WHERE name = $2 AND email = $3 AND time >= $7 AND expires_at >= $7
+) < $8
+RETURNING api_key;
+"""
+
+# Issuance times of one user inside the window, used to seed a cold counter.
+RECENT_ISSUANCE_QUERY = """
+SELECT time
+FROM api_keys
+WHERE
+ name = $1 AND
+ email = $2 AND
+ time >= $3 AND
+ expires_at >= $3;
+"""
+
+
+class IssuanceQuota:
+
+    def __init__(self, redis_client, max_keys, window=QUOTA_WINDOW, prefix="api_key_quota"):
+        """
+        Per (name, email) rolling count of issued api keys, kept in redis sorted sets.
+
+        Counters are seeded from postgres the first time a user is seen (and after they expire),
+        so postgres is only queried once per user per window instead of on every issuance.
+
+        Args:
+            redis_client (redis.asyncio.Redis): Redis client.
+            max_keys (int): Max no of keys a user can be issued in the window.
+            window (int): Window size in seconds.
+            prefix (str): Prefix of every redis key owned by the quota.
+        """
+        self.redis = redis_client
+        self.max_keys = max_keys
+        self.window = window
+        self.prefix = prefix
+        self.script = redis_client.register_script(RESERVE_SCRIPT)
+
+        self.reserved = 0
+        self.exhausted = 0
+        self.seeds = 0
+
+    def counter_key(self, name, email):
+        return f"{self.prefix}:{len(name)}:{name}:{email}"
+
+    async def reserve(self, name, email, now, load):
+        """
+        Records an issuance if the user is still under quota. Redis errors are raised to the caller.
+
+        Args:
+            name (str): Name of the user.
+            email (str): Email address of the user.
+            now (float): Issuance time in epoch seconds, the same clock the key's `time` column is written with.
+            load (Callable[[str, str, float], Awaitable[List[float]]]): Loads the user's issuance times since the given epoch from postgres.
+
+        Returns:
+            str | None: Member to pass to release() if the key could not be stored, or None if the quota is exhausted.
+        """
+        key = self.counter_key(name, email)
+        member = f"{now}:{time.monotonic_ns()}"
+        args = [now, self.window, self.max_keys, member]
+
+        outcome = await self.script(keys=[key], args=args)
+        if outcome == -1:
+            self.seeds += 1
+            issued = await load(name, email, now - self.window)
+            outcome = await self.script(keys=[key], args=args + ["seed"] + issued)
+
+        if outcome == 0:
+            self.exhausted += 1
+            return None
+
+        self.reserved += 1
+        return member
+
+    async def release(self, name, email, member):
+        """
+        Gives back a reservation whose key was never stored.
+        """
+        await self.redis.zrem(self.counter_key(name, email), member)
+
+    def stats(self):
+        return {"reserved": self.reserved, "exhausted": self.exhausted, "seeds": self.seeds}
@@ -0,0 +1,81 @@
+import time
+import uuid
+
+# Trims the window, counts it and records the call in a single atomic round trip.
+# Uses the redis server clock so every replica agrees on the window.
+# KEYS[1] = sorted set of call timestamps (ms)
+# ARGV[1] = window size (ms), ARGV[2] = max calls in the window, ARGV[3] = unique member for this call
+SLIDING_WINDOW_SCRIPT = """
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local window = tonumber(ARGV[1])
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms - window)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+
+redis.call('ZADD', KEYS[1], now_ms, ARGV[3])
+redis.call('PEXPIRE', KEYS[1], window)
+return 1
+"""
+
+# Selectable per endpoint
+BACKENDS = ("list", "zset")
+
+
+async def list_rate_limit(redis_client, key, WINDOW_SIZE, RATE_LIMIT):
+    """
+    Original sliding window on a redis list: reads every timestamp, filters them in python and
+    rewrites the list one RPUSH at a time. Not atomic across workers, kept for comparison.
+
+    Args:
+        redis_client (redis.asyncio.Redis): Redis client.
+        key (str): Key of the caller being limited.
+        WINDOW_SIZE (int): Window size in seconds.
+        RATE_LIMIT (int): Max no of calls in the window.
+
+    Returns:
+        bool: True if the call is allowed.
+    """
+    now = time.time()
+
+    # Remove timestamps outside the sliding window
+    timestamps = await redis_client.lrange(key, 0, -1)
+    valid_timestamps = [float(ts) for ts in timestamps if now - float(ts) <= WINDOW_SIZE]
+
+    if len(valid_timestamps) >= RATE_LIMIT:
+        return False
+
+    await redis_client.delete(key)
+    for ts in valid_timestamps:
+        await redis_client.rpush(key, ts)
+
+    await redis_client.rpush(key, now)  # Add current timestamp
+    await redis_client.expire(key, WINDOW_SIZE)  # Auto-expire key after window
+    return True
+
+
+class ZSetRateLimiter:
+
+    def __init__(self, redis_client):
+        """
+        Sliding window rate limiter on a redis sorted set, one atomic round trip per call.
+
+        Args:
+            redis_client (redis.asyncio.Redis): Redis client.
+        """
+        self.script = redis_client.register_script(SLIDING_WINDOW_SCRIPT)
+
+    async def allow(self, key, WINDOW_SIZE, RATE_LIMIT):
+        """
+        Args:
+            key (str): Key of the caller being limited.
+            WINDOW_SIZE (int): Window size in seconds.
+            RATE_LIMIT (int): Max no of calls in the window.
+
+        Returns:
+            bool: True if the call is allowed.
+        """
+        allowed = await self.script(keys=[key], args=[int(WINDOW_SIZE*1000), RATE_LIMIT, uuid.uuid4().hex])
+        return allowed == 1
@@ -0,0 +1,247 @@
+import asyncio
+import os
+import uuid
+
+# Seconds the lock of a running computation is held without renewal; a crashed worker frees it after this long
+SINGLE_FLIGHT_LEASE = float(os.environ.get("SINGLE_FLIGHT_LEASE", 30))
+
+# Max seconds a duplicate request waits for the running one before computing by itself
+SINGLE_FLIGHT_WAIT = float(os.environ.get("SINGLE_FLIGHT_WAIT", 600))
+
+# Seconds a finished result stays readable by duplicates that arrive just after it was published
+SINGLE_FLIGHT_RESULT_TTL = int(os.environ.get("SINGLE_FLIGHT_RESULT_TTL", 60))
+
+# Extends the lease only while this worker still holds the lock.
+# KEYS[1] = lock key, ARGV[1] = token of the holder, ARGV[2] = lease (ms)
+RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Deletes the lock only if this worker still holds it.
+# KEYS[1] = lock key, ARGV[1] = token of the holder
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+DONE = "done"
+FAILED = "failed"
+
+
+class Unshared(Exception):
+    """
+    Raised by a computation whose result is only good for its own caller (e.g. produced despite an error with the
+    caller's LLM key): the caller gets `result`, waiting duplicates are told to compute by themselves.
+    """
+
+    def __init__(self, result):
+        super().__init__("result not shared")
+        self.result = result
+
+
+class SingleFlight:
+
+    def __init__(self, redis_client, lease=SINGLE_FLIGHT_LEASE, wait_timeout=SINGLE_FLIGHT_WAIT,
+                 result_ttl=SINGLE_FLIGHT_RESULT_TTL, prefix="single_flight"):
+        """
+        Runs one computation per key at a time across every replica and worker, duplicates wait for its result.
+
+        The first caller takes a leased redis lock (renewed while it computes) and publishes the outcome on a
+        pub/sub channel. Each worker keeps a single pattern subscription for all keys and wakes its local waiters.
+        If the holder fails, is cancelled or dies (its lease runs out), a waiter takes over the computation.
+
+        Args:
+            redis_client (redis.asyncio.Redis): Redis client, must decode responses.
+            lease (float): Seconds the lock lives without renewal.
+            wait_timeout (float): Max seconds a duplicate waits before computing by itself.
+            result_ttl (int): Seconds a published result stays readable.
+            prefix (str): Prefix of every redis key and channel owned by the single flight layer.
+        """
+        self.redis = redis_client
+        self.lease = lease
+        self.wait_timeout = wait_timeout
+        self.result_ttl = result_ttl
+        self.prefix = prefix
+        self.renew_script = redis_client.register_script(RENEW_SCRIPT)
+        self.release_script = redis_client.register_script(RELEASE_SCRIPT)
+
+        # key -> futures of the requests of this worker waiting on it
+        self.waiters = {}
+        self.pubsub = None
+        self.listener = None
+
+        self.leaders = 0
+        self.followers = 0
+        self.takeovers = 0
+        self.timeouts = 0
+
+    def lock_key(self, key):
+        return f"{self.prefix}:lock:{key}"
+
+    def result_key(self, key):
+        return f"{self.prefix}:result:{key}"
+
+    def channel(self, key):
+        return f"{self.prefix}:done:{key}"
+
+    async def start(self):
+        """
+        Subscribes this worker to the outcome of every computation.
+        """
+        self.pubsub = self.redis.pubsub()
+        await self.pubsub.psubscribe(self.channel("*"))
+        self.listener = asyncio.create_task(self.listen())
+
+    async def listen(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # waiters fall back on polling the lock until the subscription is back
+                print(f"Single flight subscription failed: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            if message is None or message["type"] != "pmessage":
+                continue
+
+            key = message["channel"][len(self.channel("")):]
+            for future in self.waiters.pop(key, ()):
+                if not future.done():
+                    future.set_result(message["data"])
+
+    async def aclose(self):
+        if self.listener is not None:
+            self.listener.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+
+    async def run(self, key, compute):
+        """
+        Returns the result of compute() for this key, computing it only if no other request already is.
+
+        Args:
+            key (str): Digest of the request.
+            compute (Callable[[], Awaitable[str]]): Produces the result, only called by the lock holder. If it raises,
+                or raises Unshared, the duplicates waiting for it compete to compute it themselves.
+
+        Returns:
+            str: The result, computed here or by the request holding the lock.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+
+        while True:
+            token = uuid.uuid4().hex
+            if await self.redis.set(self.lock_key(key), token, nx=True, px=int(self.lease*1000)):
+                self.leaders += 1
+                return await self.lead(key, token, compute)
+
+            result = await self.follow(key, deadline)
+            if result is not None:
+                self.followers += 1
+                return result
+
+            if loop.time() >= deadline:
+                self.timeouts += 1
+                try:
+                    return await compute()
+                except Unshared as e:
+                    return e.result
+
+            # the holder failed or died without a result, compete for the lock again
+            self.takeovers += 1
+
+    async def lead(self, key, token, compute):
+        renewal = asyncio.create_task(self.renew(key, token))
+        try:
+            try:
+                result = await compute()
+            except Unshared as e:
+                await self.publish(key, FAILED)
+                return e.result
+            except BaseException:
+                await self.publish(key, FAILED)
+                raise
+
+            try:
+                await self.redis.set(self.result_key(key), result, ex=self.result_ttl)
+                await self.publish(key, DONE)
+            except Exception as e:
+                print(f"Single flight result could not be shared: {e}")
+            return result
+        finally:
+            renewal.cancel()
+            try:
+                await self.release_script(keys=[self.lock_key(key)], args=[token])
+            except Exception as e:
+                print(f"Single flight lock release failed, it expires with its lease: {e}")
+
+    async def renew(self, key, token):
+        while True:
+            await asyncio.sleep(self.lease/3)
+            try:
+                await self.renew_script(keys=[self.lock_key(key)], args=[token, int(self.lease*1000)])
+            except Exception as e:
+                print(f"Single flight lease renewal failed: {e}")
+
+    async def publish(self, key, outcome):
+        try:
+            await self.redis.publish(self.channel(key), outcome)
+        except Exception as e:
+            print(f"Single flight outcome could not be published: {e}")
+
+    async def follow(self, key, deadline):
+        """
+        Waits for the lock holder's outcome.
+
+        Returns:
+            str | None: The result, or None if the holder failed, died or the deadline passed.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.waiters.setdefault(key, set()).add(future)
+        try:
+            # the result may have been published before this request started waiting
+            result = await self.redis.get(self.result_key(key))
+            if result is not None:
+                return result
+
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                try:
+                    outcome = await asyncio.wait_for(asyncio.shield(future), timeout=min(self.lease, remaining))
+                except asyncio.TimeoutError:
+                    # no message yet: check that the holder is still alive (or finished while we missed the message)
+                    if await self.redis.exists(self.lock_key(key)):
+                        continue
+                    return await self.redis.get(self.result_key(key))
+
+                if outcome == DONE:
+                    return await self.redis.get(self.result_key(key))
+                return None
+        finally:
+            waiters = self.waiters.get(key)
+            if waiters is not None:
+                waiters.discard(future)
+                if not waiters:
+                    del self.waiters[key]
+            future.cancel()
+
+    def stats(self):
+        return {
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "takeovers": self.takeovers,
+            "timeouts": self.timeouts,
+            "waiting": sum(len(waiters) for waiters in self.waiters.values()),
+        }
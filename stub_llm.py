@@ -0,0 +1,169 @@
+"""
+Offline stand-in for the parts of the OpenAI API that ml_layer.ML uses (responses.create and models.list).
+
+Point the api at it with OPENAI_BASE_URL=http://llm_stub:8080/v1 (see compose.loadtest.yml) to load test the
+whole reduce pipeline without network access or API spend. Behaviour is configured with environment variables:
+
+    STUB_LATENCY_DISTRIBUTION   fixed | uniform | lognormal (default lognormal)
+    STUB_LATENCY_MS             median latency of a call in milliseconds (default 800)
+    STUB_LATENCY_SIGMA          spread of the lognormal distribution / +- fraction for uniform (default 0.5)
+    STUB_COMPRESSION_RATIO      fraction of words kept by a "concise" rewrite (default 0.7)
+    STUB_ERROR_RATE             fraction of calls that fail (default 0.0)
+    STUB_ERROR_STATUS           http status of a failed call (default 429)
+"""
+import asyncio
+import os
+import random
+import re
+import time
+import uuid
+from collections import Counter
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+STUB_LATENCY_DISTRIBUTION = os.environ.get("STUB_LATENCY_DISTRIBUTION", "lognormal")
+STUB_LATENCY_MS = float(os.environ.get("STUB_LATENCY_MS", 800))
+STUB_LATENCY_SIGMA = float(os.environ.get("STUB_LATENCY_SIGMA", 0.5))
+STUB_COMPRESSION_RATIO = float(os.environ.get("STUB_COMPRESSION_RATIO", 0.7))
+STUB_ERROR_RATE = float(os.environ.get("STUB_ERROR_RATE", 0.0))
+STUB_ERROR_STATUS = int(os.environ.get("STUB_ERROR_STATUS", 429))
+
+app = FastAPI()
+
+# no of calls served, per kind of prompt
+calls = Counter()
+
+LINE_PATTERN = re.compile(r"Current line:\n(.*?)\n\nMax no words you can (reduce|increase): (\d+)", re.S)
+COUNT_PATTERN = re.compile(r"Current word count: (\d+)\s+Goal word count: (\d+)")
+
+
+def sample_latency():
+    """
+    Returns:
+        float: Seconds the next call should take, drawn from the configured distribution.
+    """
+    median = STUB_LATENCY_MS/1000
+    if STUB_LATENCY_DISTRIBUTION == "fixed":
+        return median
+    if STUB_LATENCY_DISTRIBUTION == "uniform":
+        return random.uniform(median*(1-STUB_LATENCY_SIGMA), median*(1+STUB_LATENCY_SIGMA))
+    return random.lognormvariate(0, STUB_LATENCY_SIGMA)*median
+
+
+def message_output(text):
+    return {
+        "type": "message",
+        "id": f"msg_{uuid.uuid4().hex}",
+        "role": "assistant",
+        "status": "completed",
+        "content": [{"type": "output_text", "text": text, "annotations": []}],
+    }
+
+
+def function_call_output(name):
+    return {
+        "type": "function_call",
+        "id": f"fc_{uuid.uuid4().hex}",
+        "call_id": f"call_{uuid.uuid4().hex}",
+        "name": name,
+        "arguments": "{}",
+        "status": "completed",
+    }
+
+
+def pick_tool(message, tools):
+    """
+    Picks a tool roughly the way the real router would, from the word counts in the message.
+    """
+    names = [tool["name"] for tool in tools]
+    match = COUNT_PATTERN.search(message)
+    if not match:
+        return random.choice(names)
+
+    curr_count, goal = int(match.group(1)), int(match.group(2))
+    if curr_count < goal:
+        return "increase_words"
+    if (curr_count - goal)/curr_count > 0.25:
+        return "process_concisely"
+    return random.choice(["process_short", "decrease_words"])
+
+
+def rewrite(text, instructions):
+    """
+    Produces a plausible reply for each prompt of ml_layer.ML.
+
+    Returns:
+        Tuple[str, str]: Kind of prompt (for the call counters) and the reply text.
+    """
+    line = LINE_PATTERN.search(text)
+    if line:
+        words = line.group(1).split()
+        budget = int(line.group(3))
+        change = random.randint(0, max(1, min(budget, len(words)//3)))
+        if line.group(2) == "reduce":
+            return "shorten_line", " ".join(words[:max(1, len(words)-change)])
+        return "increase_line", " ".join(words + ["notably"]*change)
+
+    if "<CHUNK_END>" in instructions:
+        sentences = re.split(r"(?<=[.!?])\s+", text)
+        chunks = [" ".join(sentences[i:i+3]) for i in range(0, len(sentences), 3)]
+        return "segment", "<CHUNK_END>".join(chunks)
+
+    if "concise" in instructions:
+        words = text.split()
+        return "concise", " ".join(words[:max(1, int(len(words)*STUB_COMPRESSION_RATIO))])
+
+    return "grammar", text
+
+
+@app.post("/v1/responses")
+async def create_response(request: Request):
+    body = await request.json()
+    await asyncio.sleep(sample_latency())
+
+    if random.random() < STUB_ERROR_RATE:
+        calls["error"] += 1
+        return JSONResponse(
+            status_code=STUB_ERROR_STATUS,
+            headers={"retry-after": "1"},
+            content={"error": {"message": "Stub induced error", "type": "stub_error", "code": None, "param": None}},
+        )
+
+    text = body.get("input", "")
+    if body.get("tools"):
+        calls["router"] += 1
+        output = function_call_output(pick_tool(text, body["tools"]))
+    else:
+        kind, reply = rewrite(text, body.get("instructions") or "")
+        calls[kind] += 1
+        output = message_output(reply)
+
+    return {
+        "id": f"resp_{uuid.uuid4().hex}",
+        "object": "response",
+        "created_at": time.time(),
+        "model": body.get("model", "gpt-4.1"),
+        "status": "completed",
+        "output": [output],
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": body.get("tools", []),
+        "top_p": body.get("top_p"),
+    }
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "gpt-4.1", "object": "model", "created": 0, "owned_by": "stub"}]}
+
+
+@app.get("/stats")
+async def stats():
+    return {"total": sum(calls.values()), "by_kind": dict(calls)}
+
+
+@app.post("/stats/reset")
+async def reset_stats():
+    calls.clear()
+    return {"total": 0, "by_kind": {}}
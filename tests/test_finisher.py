@@ -0,0 +1,72 @@
+from ml_layer import ML, OPTION_STRINGS
+
+
+def finish(text, target):
+    return ML(text, target, OPTION_STRINGS[2], client=None).finish_exact(text)
+
+
+def test_lengthening_leaves_most_alone():
+    text = "This is the most important step."
+    assert "majority" not in finish(text, 8)
+
+
+def test_lengthening_leaves_sentence_final_before_alone():
+    text = "We had met the team before."
+    assert "prior to" not in finish(text, 7)
+
+
+def test_lengthening_despite():
+    assert finish("Despite the rain we went out.", 8) == "In spite of the rain we went out."
+
+
+def test_quite_is_not_a_filler():
+    text = "There were quite a few people at the talk."
+    assert finish(text, 8) == text
+
+
+def test_repeated_filler_is_kept():
+    text = "The results were very, very good."
+    assert "very, good" not in finish(text, 5)
+
+
+def test_filler_before_a_word_is_dropped():
+    assert finish("The results were very good.", 4) == "The results were good."
+
+
+def test_filler_before_punctuation_is_kept():
+    text = "I mean it, truly."
+    assert finish(text, 3) == text
+
+
+def test_let_us_is_not_contracted():
+    text = "Please let us know about it."
+    assert finish(text, 5) == text
+
+
+def test_its_and_theres_are_not_expanded():
+    assert finish("It's been a long day.", 6) == "It's been a long day."
+    assert finish("There's been a change.", 5) == "There's been a change."
+
+
+def test_stressed_is_is_not_contracted():
+    text = "Tell me what it is you do here."
+    assert finish(text, 7) == text
+
+
+def test_contraction_before_a_word():
+    assert finish("It is raining today.", 3) == "It's raining today."
+
+
+def test_very_is_not_added_to_verbs_or_adverbs():
+    assert finish("Please clear the cache now.", 6) == "Please clear the cache now."
+    assert finish("Trains move people fast.", 5) == "Trains move people fast."
+
+
+def test_very_is_not_added_after_negation():
+    text = "This is not important."
+    assert finish(text, 5) == text
+
+
+def test_very_is_added_to_adjectives():
+    assert finish("This is important.", 4) == "This is very important."
+    assert finish("It was a fast car.", 6) == "It was a very fast car."
@@ -0,0 +1,54 @@
+import asyncio
+import types
+
+from cache import LLMCache
+from llm_governor import LLMGovernor
+from ml_layer import ML, OPTION_STRINGS
+
+
+class Responses:
+
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, **params):
+        self.calls += 1
+        text = f"reply {self.calls}"
+        return types.SimpleNamespace(output=[types.SimpleNamespace(content=[types.SimpleNamespace(text=text)])])
+
+
+class Client:
+
+    def __init__(self):
+        self.api_key = "test-key"
+        self.responses = Responses()
+
+
+def make_ml(client, cache):
+    return ML("some text", 2, OPTION_STRINGS[2], client, cache=cache, governor=LLMGovernor(rate=0))
+
+
+def test_resent_prompt_gets_a_fresh_reply():
+    async def run():
+        client = Client()
+        ml_instance = make_ml(client, LLMCache())
+        first = await ml_instance.complete("same input", "same instructions")
+        second = await ml_instance.complete("same input", "same instructions")
+        assert first != second
+        assert client.responses.calls == 2
+
+    asyncio.run(run())
+
+
+def test_identical_run_replays_from_the_cache():
+    async def run():
+        client = Client()
+        cache = LLMCache()
+        first_run = make_ml(client, cache)
+        replies = [await first_run.complete("same input", "same instructions") for _ in range(2)]
+
+        second_run = make_ml(client, cache)
+        assert [await second_run.complete("same input", "same instructions") for _ in range(2)] == replies
+        assert client.responses.calls == 2
+
+    asyncio.run(run())
@@ -0,0 +1,112 @@
+import asyncio
+import types
+
+import pytest
+
+from llm_clients import key_id
+from llm_governor import CircuitOpenError, LLMGovernor
+
+
+class Responses:
+
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, **params):
+        self.calls += 1
+        return types.SimpleNamespace(output=[])
+
+
+class Client:
+
+    def __init__(self, api_key="test-key"):
+        self.api_key = api_key
+        self.responses = Responses()
+
+
+def open_circuit(governor, client):
+    _, breaker = governor.key_state(key_id(client.api_key))
+    breaker.failures = breaker.threshold
+    breaker.opened_at = 0.0   # long enough ago for the next call to be the probe
+    return breaker
+
+
+def test_probe_cancelled_while_waiting_for_a_slot_does_not_wedge_the_circuit():
+    async def run():
+        governor = LLMGovernor(max_per_worker=1, rate=0)
+        client = Client()
+        breaker = open_circuit(governor, client)
+
+        # the only worker slot is taken, so the probe waits for it
+        await governor.worker_semaphore.acquire()
+        probe = asyncio.create_task(governor.call(client, model="m", input="x"))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        governor.worker_semaphore.release()
+
+        assert not breaker.probing
+        # the next call is let through as the probe and closes the circuit
+        await governor.call(client, model="m", input="x")
+        assert breaker.state == "closed"
+        assert client.responses.calls == 1
+
+    asyncio.run(run())
+
+
+def test_probe_cancelled_while_waiting_for_a_token_does_not_wedge_the_circuit():
+    async def run():
+        governor = LLMGovernor(rate=0.01, burst=1)
+        client = Client()
+        breaker = open_circuit(governor, client)
+        await governor.take_token(key_id(client.api_key))   # empties the key's bucket
+
+        probe = asyncio.create_task(governor.call(client, model="m", input="x"))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert not breaker.probing
+
+    asyncio.run(run())
+
+
+def test_open_circuit_rejects_while_a_probe_is_in_flight():
+    async def run():
+        governor = LLMGovernor(max_per_worker=1, rate=0)
+        client = Client()
+        open_circuit(governor, client)
+
+        await governor.worker_semaphore.acquire()
+        probe = asyncio.create_task(governor.call(client, model="m", input="x"))
+        await asyncio.sleep(0.01)
+        with pytest.raises(CircuitOpenError):
+            await governor.call(client, model="m", input="x")
+
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_throttled_key_does_not_hold_a_worker_slot():
+    async def run():
+        governor = LLMGovernor(max_per_worker=1, rate=0.01, burst=1)
+        throttled, other = Client("throttled-key"), Client("other-key")
+        await governor.take_token(key_id(throttled.api_key))   # empties the throttled key's bucket
+
+        waiting = asyncio.create_task(governor.call(throttled, model="m", input="x"))
+        await asyncio.sleep(0.01)
+        # the throttled call sleeps for its token without the only worker slot
+        await asyncio.wait_for(governor.call(other, model="m", input="x"), timeout=1)
+        assert other.responses.calls == 1
+
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+
+    asyncio.run(run())
@@ -0,0 +1,51 @@
+import asyncio
+import types
+
+import pytest
+
+from llm_governor import LLMGovernor
+from ml_layer import ML, OPTION_STRINGS, PipelineError
+
+TEXT = " ".join(f"Sentence number {i} talks about a topic in some detail." for i in range(10))
+
+
+class Responses:
+
+    def __init__(self, working_calls):
+        self.working_calls = working_calls
+        self.calls = 0
+
+    async def create(self, input, **params):
+        self.calls += 1
+        if self.calls > self.working_calls:
+            raise ValueError("invalid request")
+        return types.SimpleNamespace(output=[types.SimpleNamespace(content=[types.SimpleNamespace(text=input)])])
+
+
+class Client:
+
+    def __init__(self, working_calls):
+        self.api_key = "test-key"
+        self.responses = Responses(working_calls)
+
+
+def process(target, tolerance, working_calls):
+    ml_instance = ML(TEXT, target, OPTION_STRINGS[2], Client(working_calls), tolerance=tolerance,
+                     governor=LLMGovernor(rate=0))
+    return asyncio.run(ml_instance.process_text())
+
+
+def test_failure_before_any_text_is_an_error():
+    with pytest.raises(PipelineError):
+        process(40, 0, working_calls=0)
+
+
+def test_failure_after_the_grammar_fix_is_an_error():
+    # only the grammar fix gets an answer, its output is 60 words off the target
+    with pytest.raises(PipelineError, match="Error during processing"):
+        process(40, 0, working_calls=1)
+
+
+def test_input_within_the_tolerance_needs_no_rewrite():
+    text, count = process(98, 2, working_calls=1)
+    assert count == 100
@@ -0,0 +1,195 @@
+"""
+Per-request traces of the api and ML pipeline stages.
+
+A trace is started once per request with start_trace(); anything running inside it (including tasks spawned by
+asyncio.gather) opens child spans with span(). Outside a sampled trace span() costs one context variable lookup.
+
+    TRACE_SAMPLE_RATE   fraction of requests traced (default 0.0); a request with `X-Trace: 1` is always traced
+    TRACE_EXPORTER      file | memory (default memory)
+    TRACE_FILE          jsonl file finished traces are appended to by the file exporter (default traces.jsonl)
+    TRACE_MEMORY_SIZE   no of finished traces kept by the memory exporter (default 200)
+"""
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.0))
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "memory")
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+TRACE_MEMORY_SIZE = int(os.environ.get("TRACE_MEMORY_SIZE", 200))
+
+# span the code currently running belongs to, None outside a sampled trace
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+
+    # attributes that are expensive to compute are only worth it on a recording span
+    recording = True
+
+    def __init__(self, name, trace, parent_id=None, attributes=None):
+        self.name = name
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.duration_ms = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self.started)*1000
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class NoopSpan:
+    """Returned outside a sampled trace, so callers can always call set()."""
+
+    recording = False
+
+    def set(self, **attributes):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Trace:
+
+    def __init__(self, name):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+
+    def to_dict(self):
+        root = self.spans[0] if self.spans else None
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start": root.start if root else None,
+            "duration_ms": root.duration_ms if root else None,
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+
+class MemoryExporter:
+
+    def __init__(self, max_traces=TRACE_MEMORY_SIZE):
+        """
+        Keeps the last `max_traces` finished traces of this worker in memory.
+        """
+        self.traces = deque(maxlen=max_traces)
+
+    def export(self, trace):
+        self.traces.append(trace.to_dict())
+
+
+class FileExporter:
+
+    def __init__(self, path=TRACE_FILE):
+        """
+        Appends every finished trace to a jsonl file, one trace per line.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, trace):
+        line = json.dumps(trace.to_dict())
+        with self.lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+exporter = FileExporter() if TRACE_EXPORTER == "file" else MemoryExporter()
+
+
+@contextmanager
+def start_trace(name, sample_rate=None, force=False, **attributes):
+    """
+    Starts a trace with a root span, if the request is sampled, and exports it when the block exits.
+
+    Args:
+        name (str): Name of the trace and its root span (usually the endpoint).
+        sample_rate (float, optional): Overrides TRACE_SAMPLE_RATE.
+        force (bool): Trace regardless of the sample rate.
+        **attributes: Attributes of the root span.
+
+    Yields:
+        Span | NoopSpan: The root span.
+    """
+    sample_rate = TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+    if not force and random.random() >= sample_rate:
+        yield NOOP_SPAN
+        return
+
+    trace = Trace(name)
+    root = Span(name, trace, attributes=attributes)
+    trace.spans.append(root)
+    token = current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.error = repr(e)
+        raise
+    finally:
+        root.finish()
+        current_span.reset(token)
+        try:
+            exporter.export(trace)
+        except Exception as e:
+            print(f"Trace export failed: {e}")
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Opens a child span of the current span, if the code runs inside a sampled trace.
+
+    Yields:
+        Span | NoopSpan: The span, attributes can be added with set() while it is open.
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+
+    child = Span(name, parent.trace, parent_id=parent.span_id, attributes=attributes)
+    parent.trace.spans.append(child)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = repr(e)
+        raise
+    finally:
+        child.finish()
+        current_span.reset(token)
+
+
+def recent_traces(limit=50):
+    """
+    Returns:
+        List[dict]: The most recent traces kept by the memory exporter (empty with the file exporter).
+    """
+    if not isinstance(exporter, MemoryExporter):
+        return []
+    return list(exporter.traces)[-limit:][::-1]
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+
+import httpx
+import redis.asyncio as aioredis
+
+from cache import LLMCache
+from llm_clients import ClientRegistry
+from llm_governor import LLMGovernor
+from ml_layer import ML, OPTION_STRINGS, PipelineError
+
+# Redis list the api pushes jobs onto and the workers pop them from
+JOB_QUEUE_KEY = "reduce_jobs:queue"
+
+# Prefix of the redis hash holding the status / result of a job
+JOB_KEY_PREFIX = "reduce_jobs:job"
+
+# How long (in seconds) a job's status and result are kept
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", 60*60))
+
+# How long (in seconds) a queued job's LLM key is kept; it is stored apart from the queue and deleted once a worker
+# claims the job, so it never sits in the redis snapshots for longer than that
+JOB_KEY_TTL = min(int(os.environ.get("JOB_KEY_TTL", 15*60)), JOB_RESULT_TTL)
+
+# Max no of jobs a single worker process runs at once
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 4))
+
+# Seconds a callback POST can take before it is abandoned
+CALLBACK_TIMEOUT = 10
+
+
+def job_key(job_id):
+    return f"{JOB_KEY_PREFIX}:{job_id}"
+
+
+def llm_key_key(job_id):
+    return f"reduce_jobs:llm_key:{job_id}"
+
+
+def processing_key(worker_name):
+    # jobs a worker has popped but not finished yet, so they can be requeued if it crashes
+    return f"reduce_jobs:processing:{worker_name}"
+
+
+async def enqueue_job(redis_client, llm_api_key, payload):
+    """
+    Records a new job as queued and pushes it onto the job queue. The LLM key is kept out of the queue entry, under
+    its own key expiring after JOB_KEY_TTL seconds.
+
+    Args:
+        redis_client (redis.asyncio.Redis): Client created with decode_responses=True.
+        llm_api_key (str): LLM key the job runs with.
+        payload (dict): option, input_text, no_of_words, tolerance, no_cache and callback_url of the job.
+
+    Returns:
+        str: Id of the queued job.
+    """
+    job_id = uuid.uuid4().hex
+
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(job_key(job_id), mapping={"status": "queued", "submitted_at": time.time()})
+        pipe.expire(job_key(job_id), JOB_RESULT_TTL)
+        pipe.set(llm_key_key(job_id), llm_api_key, ex=JOB_KEY_TTL)
+        pipe.lpush(JOB_QUEUE_KEY, json.dumps({"job_id": job_id, **payload}))
+        await pipe.execute()
+
+    return job_id
+
+
+async def get_job(redis_client, job_id):
+    """
+    Returns:
+        dict | None: Status (and result once done) of the job, or None if it is unknown or expired.
+    """
+    job = await redis_client.hgetall(job_key(job_id))
+    if not job:
+        return None
+
+    job["job_id"] = job_id
+    if "processed_text_length" in job:
+        job["processed_text_length"] = int(job["processed_text_length"])
+    return job
+
+
+async def run_job(redis_client, payload, llm_cache, llm_clients, llm_governor=None):
+    """
+    Runs the ML pipeline for one job, stores the result and fires the optional callback.
+
+    Args:
+        redis_client (redis.asyncio.Redis): Client created with decode_responses=True.
+        payload (dict): Job as pushed by enqueue_job.
+        llm_cache (LLMCache): Cache of LLM responses shared with the api.
+        llm_clients (ClientRegistry): This worker's pooled OpenAI clients.
+        llm_governor (LLMGovernor, optional): Gate of this worker's LLM calls, shares its rate limits with the api.
+    """
+    job_id = payload["job_id"]
+    # claiming the job deletes its LLM key, a job requeued after a crash fails rather than keeping it around
+    llm_api_key = await redis_client.getdel(llm_key_key(job_id))
+    if llm_api_key is None and not await redis_client.exists(job_key(job_id)):
+        # queue entries do not expire, the job itself did while it was waiting
+        print(f"Job {job_id} expired before it ran, dropped")
+        return
+
+    await redis_client.hset(job_key(job_id), mapping={"status": "running", "started_at": time.time()})
+
+    try:
+        if llm_api_key is None:
+            raise PipelineError("The job's LLM key expired before it ran, submit it again")
+        client = llm_clients.get_client(llm_api_key)
+        # no_cache: a fresh run, the LLM responses cached by identical earlier runs are not replayed
+        ml_instance = ML(payload["input_text"], payload["no_of_words"], OPTION_STRINGS[payload["option"]], client,
+                         cache=None if payload.get("no_cache") else llm_cache,
+                         tolerance=payload.get("tolerance", 0), governor=llm_governor)
+        processed_text, processed_text_length = await ml_instance.process_text()
+        result = {"status": "done", "processed_text": processed_text, "processed_text_length": processed_text_length}
+    except PipelineError as e:
+        result = {"status": "failed", "error": str(e)}
+    except Exception as e:
+        # a bug rather than a pipeline failure, its details stay in the logs
+        print(f"Job {job_id} failed unexpectedly: {e!r}")
+        result = {"status": "failed", "error": "Internal error while processing the job"}
+
+    result["finished_at"] = time.time()
+
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(job_key(job_id), mapping=result)
+        pipe.expire(job_key(job_id), JOB_RESULT_TTL)
+        await pipe.execute()
+
+    if payload.get("callback_url"):
+        try:
+            async with httpx.AsyncClient(timeout=CALLBACK_TIMEOUT) as http_client:
+                await http_client.post(payload["callback_url"], json={"job_id": job_id, **result})
+        except Exception as e:
+            print(f"Callback for job {job_id} failed: {e}")
+
+
+async def worker_loop(redis_client, concurrency=WORKER_CONCURRENCY, worker_name=None):
+    """
+    Pops jobs off the queue and runs up to `concurrency` of them at once, forever.
+
+    Jobs are moved atomically onto a per-worker processing list while they run, and anything left on
+    that list from a previous crash is requeued on startup.
+
+    Args:
+        redis_client (redis.asyncio.Redis): Client created with decode_responses=True.
+        concurrency (int): Max no of jobs run at once by this process.
+        worker_name (str, optional): Stable name of this worker, defaults to hostname:pid.
+    """
+    worker_name = worker_name or f"{socket.gethostname()}:{os.getpid()}"
+    in_progress = processing_key(worker_name)
+    llm_cache = LLMCache(redis_client=redis_client)
+    llm_clients = ClientRegistry()
+    llm_governor = LLMGovernor(redis_client=redis_client)
+
+    # requeue jobs this worker popped but never finished
+    while await redis_client.lmove(in_progress, JOB_QUEUE_KEY, "RIGHT", "RIGHT"):
+        pass
+
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def run(raw):
+        try:
+            await run_job(redis_client, json.loads(raw), llm_cache, llm_clients, llm_governor)
+        except Exception as e:
+            print(f"Job failed unexpectedly: {e}")
+        finally:
+            await redis_client.lrem(in_progress, 1, raw)
+            semaphore.release()
+
+    print(f"Worker {worker_name} waiting for jobs (concurrency {concurrency})")
+    while True:
+        # only take a job off the queue once there is room to run it
+        await semaphore.acquire()
+        raw = await redis_client.blmove(JOB_QUEUE_KEY, in_progress, timeout=5, src="RIGHT", dest="LEFT")
+        if raw is None:
+            semaphore.release()
+            continue
+
+        task = asyncio.create_task(run(raw))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+if __name__ == "__main__":
+    # stable per-container name so a restarted worker picks up its own unfinished jobs
+    redis_client = aioredis.Redis(host='redis', port=6379, db=0, decode_responses=True)
+    asyncio.run(worker_loop(redis_client, worker_name=os.environ.get("WORKER_NAME", socket.gethostname())))